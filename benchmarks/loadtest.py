@@ -0,0 +1,404 @@
+"""Offline load test for the Music cog.
+
+Simulates a number of guilds issuing play/skip/queue/remove at once against
+stub Discord objects. youtube_dl is replaced by canned info dicts and every
+stream is a local audio file served over HTTP, so FFmpeg, the extraction
+pool, the voice players and the queue all run for real.
+
+Reports command latency percentiles, event loop lag, memory per guild and
+the frames per second each fake voice client received (Discord expects 50).
+
+Run from the repository root: python benchmarks/loadtest.py --guilds 50 --duration 60
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import http.server
+import itertools
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from discord.ext import commands
+
+import main
+
+TRACK_SECONDS = 20
+
+# Relative weights of the commands each simulated user sends
+COMMANDS = {'play': 3, 'queue': 4, 'skip': 1, 'remove': 1}
+
+ids = itertools.count(1)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.id = next(ids)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, *, content=None, embed=None):
+        await asyncio.sleep(self.channel.send_delay)
+        self.channel.edits += 1
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(self.channel.send_delay)
+
+
+class FakeTextChannel:
+    def __init__(self, guild, send_delay):
+        self.id = next(ids)
+        self.guild = guild
+        self.send_delay = send_delay
+        self.last_message_id = None
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content=None, *, embed=None):
+        # Stands in for the HTTP round trip, rate limiter included
+        await asyncio.sleep(self.send_delay)
+        message = FakeMessage(self, content, embed)
+        self.last_message_id = message.id
+        self.sent += 1
+        return message
+
+    def typing(self):
+        return Typing()
+
+
+class Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeVoiceClient:
+    """Drives discord.py's own AudioPlayer, counting packets instead of sending them."""
+
+    def __init__(self, channel, loop):
+        self.channel = channel
+        self.loop = loop
+        self.ws = self
+        self.frames = 0
+        # Encoding PCM is most of what the PCM path costs, but needs libopus
+        self.encoder = discord.opus.Encoder() if discord.opus.is_loaded() else None
+
+        self._connected = threading.Event()
+        self._connected.set()
+        self._player = None
+
+    async def speak(self, speaking):
+        pass
+
+    def send_audio_packet(self, data, *, encode=True):
+        if encode and self.encoder is not None:
+            data = self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+        self.frames += 1
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+
+        self._player = discord.player.AudioPlayer(source, self, after=after)
+        self._player.start()
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self._connected.clear()
+        self.channel.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.id = next(ids)
+        self.guild = guild
+
+    async def connect(self):
+        voice = FakeVoiceClient(self, asyncio.get_event_loop())
+        self.guild.voice_client = voice
+        self.guild.voice_clients.append(voice)
+        return voice
+
+
+class FakeMember:
+    def __init__(self, guild, voice_channel=None):
+        self.id = next(ids)
+        self.guild = guild
+        self.name = 'user{}'.format(self.id)
+        self.mention = '<@{}>'.format(self.id)
+        self.voice = types.SimpleNamespace(channel=voice_channel) if voice_channel else None
+
+
+class FakeGuild:
+    def __init__(self, send_delay):
+        self.id = next(ids)
+        self.shard_id = None
+        self.voice_client = None
+        # Every voice client this guild ever had, for counting frames afterwards
+        self.voice_clients = []
+
+        self.voice_channel = FakeVoiceChannel(self)
+        self.text_channel = FakeTextChannel(self, send_delay)
+        self.me = FakeMember(self)
+        self.user = FakeMember(self, self.voice_channel)
+
+    def get_member(self, member_id):
+        return next((member for member in (self.me, self.user) if member.id == member_id), None)
+
+    @property
+    def frames(self):
+        return sum(voice.frames for voice in self.voice_clients)
+
+
+class FakeContext:
+    def __init__(self, bot, guild):
+        self.bot = bot
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = guild.user
+        self.message = FakeMessage(self.channel)
+        self.message.author = self.author
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    def typing(self):
+        return Typing()
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command(self, *args, **kwargs)
+
+
+def make_track(directory):
+    path = os.path.join(directory, 'track.webm')
+    subprocess.run([main.YTDLSource.ffmpeg_executable(), '-loglevel', 'error', '-y', '-f', 'lavfi',
+                    '-i', 'sine=frequency=440:duration={}'.format(TRACK_SECONDS), '-c:a', 'libopus', '-b:a', '96k',
+                    path], check=True)
+    return path
+
+
+def serve(directory):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    class Server(http.server.ThreadingHTTPServer):
+        def handle_error(self, request, client_address):
+            # FFmpeg hangs up mid-file whenever a song is skipped
+            pass
+
+    server = Server(('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fake_extractor(stream_url, delay):
+    def extract_info(url, process=True, max_entries=None):
+        # Runs in the extraction pool's threads like the real thing
+        time.sleep(delay)
+
+        if not url.startswith('http'):
+            slug = url.replace(' ', '-')
+            entries = [{'webpage_url': 'https://example.com/{}/{}'.format(slug, i), 'title': '{} #{}'.format(url, i),
+                        'duration': TRACK_SECONDS} for i in range(max_entries or 1)]
+            return {'entries': entries}
+
+        return {
+            'title': url.rsplit('/', 2)[-2], 'uploader': 'Load Test', 'uploader_url': 'https://example.com',
+            'upload_date': '20200101', 'thumbnail': 'https://example.com/thumb.jpg', 'duration': TRACK_SECONDS,
+            'webpage_url': url, 'view_count': 1, 'like_count': 1, 'dislike_count': 0, 'url': stream_url,
+            'acodec': 'opus', 'description': 'x' * 2000, 'tags': ['load', 'test'] * 10,
+        }
+
+    return extract_info
+
+
+async def invoke(music, name, ctx, stats, *args, **kwargs):
+    command = getattr(music, '_' + name)
+    ctx.command = command
+    started = time.perf_counter()
+    try:
+        await command.call_before_hooks(ctx)
+        await command(ctx, *args, **kwargs)
+    except commands.CommandError as e:
+        await music.cog_command_error(ctx, e)
+    finally:
+        stats[name].append(time.perf_counter() - started)
+
+
+async def user(music, bot, guild, stats, args, rng):
+    ctx = FakeContext(bot, guild)
+    await invoke(music, 'play', ctx, stats, search='guild {} song 0'.format(guild.id))
+    # Only exactly 100%, the default, lets Opus streams skip FFmpeg's re-encode,
+    # anything lower measures the volume filter and libopus
+    ctx.voice_state.volume = args.volume / 100
+
+    deadline = time.perf_counter() + args.duration
+    names = list(COMMANDS)
+    weights = [COMMANDS[name] for name in names]
+    song = 1
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.uniform(0.5, 2) * args.think)
+
+        ctx = FakeContext(bot, guild)
+        name = rng.choices(names, weights)[0]
+        if name == 'play':
+            # Repeats some searches so the caches get their share of hits
+            await invoke(music, name, ctx, stats, search='guild {} song {}'.format(guild.id, rng.randrange(song + 1)))
+            song += 1
+        elif name == 'remove':
+            await invoke(music, name, ctx, stats, 1)
+        elif name == 'queue':
+            await invoke(music, name, ctx, stats, page=1)
+        else:
+            await invoke(music, name, ctx, stats)
+
+
+async def watch_loop(lags, interval=0.05):
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - started - interval)
+
+
+def percentiles(values, points=(50, 95, 99)):
+    values = sorted(values)
+    if not values:
+        return [0.0] * (len(points) + 1)
+    return [values[min(len(values) - 1, int(len(values) * p / 100))] for p in points] + [values[-1]]
+
+
+async def run(args):
+    bot = main.bot
+    rng = random.Random(args.seed)
+
+    discord.opus._load_default()
+    main.Music.SNAPSHOT_PATH = None
+    main.YTDLSource.PLAYBACK_MODE = args.mode
+    main.Outbox.LINGER = args.linger
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_track(directory)
+        server = serve(directory)
+        stream_url = 'http://127.0.0.1:{}/track.webm'.format(server.server_address[1])
+        main._extract_info = fake_extractor(stream_url, args.extract_delay)
+
+        music = main.Music(bot)
+        bot.add_cog(music)
+        guilds = [FakeGuild(args.send_delay) for _ in range(args.guilds)]
+
+        stats = collections.defaultdict(list)
+        lags = []
+        watcher = asyncio.ensure_future(watch_loop(lags))
+        rss = main._rss()
+        started = time.perf_counter()
+
+        await asyncio.gather(*(user(music, bot, guild, stats, args, rng) for guild in guilds))
+
+        elapsed = time.perf_counter() - started
+        state_stats = music.shard_stats(0)
+        rss = main._rss() - rss
+        watcher.cancel()
+
+        for states in music.voice_states.values():
+            for state in list(states.values()):
+                await state.stop()
+        bot.remove_cog(music.qualified_name)
+        main.YTDLSource.pool.shutdown()
+        server.shutdown()
+
+    report(args, stats, lags, guilds, state_stats, rss, elapsed)
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(main.metrics.render())
+
+
+def report(args, stats, lags, guilds, state_stats, rss, elapsed):
+    print('{} guilds for {:.0f}s, {} playback{} at {}% volume, {:.2f}s extraction, {:.0f}ms sends'.format(
+        args.guilds, elapsed, args.mode, '' if discord.opus.is_loaded() else ' (libopus missing, PCM not encoded)',
+        args.volume, args.extract_delay, args.send_delay * 1000))
+
+    print('\n{:<8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('command', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, values in sorted(stats.items()):
+        print('{:<8} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            name, len(values), *(value * 1000 for value in percentiles(values))))
+
+    print('\nevent loop lag: p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(
+        *(lag * 1000 for lag in percentiles(lags))))
+
+    fps = [guild.frames / elapsed for guild in guilds]
+    print('frames/s per guild: mean {:.1f}, min {:.1f} (50 is real time, gaps between songs count against it)'.format(
+        sum(fps) / len(fps), min(fps)))
+
+    print('memory: {:.1f} KiB RSS per guild, {:.1f} KiB of voice state per guild'.format(
+        rss / 1024 / len(guilds), state_stats['state_bytes'] / 1024 / max(state_stats['voice_states'], 1)))
+
+    messages = sum(guild.text_channel.sent for guild in guilds)
+    edits = sum(guild.text_channel.edits for guild in guilds)
+    print('messages: {} sent, {} edited, {} coalesced'.format(messages, edits, main.Outbox.stats['coalesced']))
+
+    cache = main.YTDLSource.cache.stats()
+    print('info cache: {}'.format(', '.join('{} {}'.format(key, value) for key, value in sorted(cache.items()))))
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30, help='seconds each guild keeps sending commands')
+    parser.add_argument('--think', type=float, default=1.0, help='scales the 0.5-2s pause between commands')
+    parser.add_argument('--extract-delay', type=float, default=0.3, help='seconds each fake extraction takes')
+    parser.add_argument('--send-delay', type=float, default=0.05, help='seconds each fake message send takes')
+    parser.add_argument('--volume', type=int, default=100)
+    parser.add_argument('--linger', type=float, default=main.Outbox.LINGER)
+    parser.add_argument('--mode', choices=('opus', 'pcm'), default=main.YTDLSource.PLAYBACK_MODE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', metavar='PATH', help='also write the bot\'s own metrics here')
+    args = parser.parse_args()
+
+    main.bot.loop.run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    cli()
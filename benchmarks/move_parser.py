@@ -0,0 +1,80 @@
+"""Compares the tictactoe move parser with the chained re.search parsing it replaced.
+
+Run from the repository root: python benchmarks/move_parser.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import MoveParseError, parse_move
+
+MOVES = ["top left", "middle", "bottom right", "top", "left", "middle right", "top bottom", "somewhere"]
+# Cells that aren't on a 3x3 board, which must not be read as part of themselves
+INVALID = ["10", "a10", "d1", "0", "c4"]
+
+
+def legacy_parse(option):
+    # The parsing TicTacToe.tictactoe used to do inline, minus the messages
+    top = re.search("top", option)
+    middle = re.search("middle", option)
+    bottom = re.search("bottom", option)
+    left = re.search("left", option)
+    right = re.search("right", option)
+
+    if top and bottom:
+        return None
+    if left and right:
+        return None
+    if not top and not bottom and not left and not right and not middle:
+        return None
+
+    x = 0
+    y = 0
+    if top:
+        x = 0
+    if bottom:
+        x = 2
+    if left:
+        y = 0
+    if right:
+        y = 2
+    if middle and not (top or bottom or left or right):
+        x = 1
+        y = 1
+    if (top or bottom) and not (left or right):
+        y = 1
+    elif (left or right) and not (top or bottom):
+        x = 1
+    return x, y
+
+
+def new_parse(option):
+    try:
+        return parse_move(option)
+    except MoveParseError:
+        return None
+
+
+def main():
+    # Both parsers have to agree before their speed means anything
+    for move in MOVES:
+        assert legacy_parse(move) == new_parse(move), move
+    for move in INVALID:
+        try:
+            parse_move(move)
+        except MoveParseError as e:
+            assert e.code == "invalid", move
+        else:
+            raise AssertionError(move)
+
+    number = 20000
+    for name, func in (("legacy", legacy_parse), ("tokenizer", new_parse)):
+        seconds = min(timeit.repeat(lambda: [func(move) for move in MOVES], number=number, repeat=5))
+        print("{:<10} {:8.0f} ns/move".format(name, seconds / (number * len(MOVES)) * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,856 @@
 import asyncio
+import audioop
+import bisect
+import collections
+import concurrent.futures
 import functools
+import importlib
+import io
 import itertools
+import json
 import math
+import os
 import random
-import imageio_ffmpeg
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import weakref
+
+_imports_started = time.perf_counter()
+
 import discord
-import youtube_dl
 from async_timeout import timeout
-from discord.ext import commands
+from discord.ext import commands, tasks
+
+_started = time.perf_counter()
+
+# Seconds each stage of startup took, in order, and the modules imported
+# lazily afterwards, for the ready report
+startup = collections.OrderedDict(imports=_started - _imports_started)
+deferred = collections.OrderedDict()
+_last_stage = _started
+
+
+def _stage_done(stage: str):
+    global _last_stage
+    now = time.perf_counter()
+    startup[stage] = now - _last_stage
+    _last_stage = now
+
+
+class _LazyModule:
+    """Imports a module the first time one of its attributes is used.
+
+    youtube_dl alone takes longer to import than discord.py, and isn't
+    needed before the first song is looked up.
+    """
 
-# Silence useless bug reports messages
-youtube_dl.utils.bug_reports_message = lambda: ''
+    def __init__(self, name: str, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+    def _load(self):
+        # Extraction threads and the warmup can race to be first
+        with self._lock:
+            if self._module is None:
+                started = time.perf_counter()
+                module = importlib.import_module(self._name)
+                if self._setup is not None:
+                    self._setup(module)
+
+                deferred[self._name] = time.perf_counter() - started
+                self._module = module
+
+        return self._module
+
+
+def _setup_youtube_dl(module):
+    # Silence useless bug reports messages
+    module.utils.bug_reports_message = lambda: ''
+
+
+youtube_dl = _LazyModule('youtube_dl', _setup_youtube_dl)
+imageio_ffmpeg = _LazyModule('imageio_ffmpeg')
 
 
 class VoiceError(Exception):
-    pass
+    def __init__(self, *args):
+        super().__init__(*args)
+        ERRORS.inc(type='voice')
 
 
 class YTDLError(Exception):
-    pass
+    def __init__(self, *args):
+        super().__init__(*args)
+        ERRORS.inc(type='ytdl')
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def _key(self, labels: dict):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format(self, key: tuple, extra: str = None):
+        pairs = ['{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"'))
+                 for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+        yield from self.samples()
+
+
+class CounterMetric(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = collections.defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[self._key(labels)] += amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield '{}{} {}'.format(self.name, self._format(key), value)
+
+
+class HistogramMetric(_Metric):
+    kind = 'histogram'
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, *args, buckets: tuple = BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # label values -> [per bucket counts, the last one being +Inf, sum]
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, self._format(key, 'le="{}"'.format(bound)), cumulative)
+            yield '{}_sum{} {}'.format(self.name, self._format(key), total)
+            yield '{}_count{} {}'.format(self.name, self._format(key), cumulative)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: HistogramMetric, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class GaugeMetric(_Metric):
+    """Read when scraped, from a callable returning a value or a `{label values: value}` dict."""
+
+    kind = 'gauge'
+
+    def __init__(self, *args, callback, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+
+        for key, value in value.items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield '{}{} {}'.format(self.name, self._format(tuple(map(str, key))), value)
+
+
+class Metrics:
+    """Prometheus style metrics, rendered in its text format.
+
+    Recording is a dict lookup and an add, cheap enough to leave on. Gauges
+    are only computed when scraped.
+    """
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()):
+        return self._add(CounterMetric(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), **kwargs):
+        return self._add(HistogramMetric(name, documentation, labels, **kwargs))
+
+    def gauge(self, name: str, documentation: str, callback, labels: tuple = ()):
+        # Re-registering replaces the callback, so a reloaded cog doesn't keep its old one alive
+        return self._add(GaugeMetric(name, documentation, labels, callback=callback))
+
+    def _add(self, metric: _Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # A broken gauge shouldn't take the rest down with it
+                lines.append('# {} failed: {!r}'.format(metric.name, e))
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str, port: int):
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                # Whatever the path, the request only gets the metrics back
+                await reader.readuntil(b'\r\n\r\n')
+                body = self.render().encode()
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(body) + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+metrics = Metrics()
+
+EXTRACT_SECONDS = metrics.histogram('ytdl_extract_seconds', 'youtube_dl lookups by stage, queueing included.',
+                                    ('stage',))
+FIRST_FRAME_SECONDS = metrics.histogram('music_first_frame_seconds',
+                                        'Time to a song\'s first audio frame, from the command that queued it '
+                                        'into an idle player, or from leaving the queue, and whether its FFmpeg '
+                                        'process was pre-spawned.', ('since', 'start'))
+FFMPEG_SPAWN_SECONDS = metrics.histogram('ffmpeg_spawn_seconds', 'Time to start an FFmpeg process.', ('mode',))
+LOOP_LAG = metrics.histogram('event_loop_lag_seconds', 'How late the event loop runs a timer.',
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+ERRORS = metrics.counter('bot_errors_total', 'Errors raised, by type.', ('type',))
+FFMPEG_WARM = metrics.counter('ffmpeg_warm_total', 'Pre-spawned FFmpeg processes, by whether they got played, '
+                              'made room for another or failed the health check.', ('outcome',))
+STALLS = metrics.counter('event_loop_stalls_total', 'Times the event loop was blocked past the watchdog\'s threshold, '
+                         'by what was running.', ('where',))
+
+
+def _frame_name(code):
+    return getattr(code, 'co_qualname', code.co_name)
+
+
+class LoopWatchdog:
+    """Notices when something blocks the event loop, and catches it in the act.
+
+    A task on the loop beats every `interval`. A thread watching it grabs
+    the loop thread's stack once a beat is `threshold` late, and blames the
+    command being run, or else the innermost function of this file.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, keep: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+
+        self.stalls = collections.deque(maxlen=keep)
+        # task -> name of the command it's running
+        self.commands = weakref.WeakKeyDictionary()
+
+        self._loop = None
+        self._thread_id = None
+        self._beat = time.perf_counter()
+        self._stall = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if self._loop is not None:
+            return
+
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    async def _heartbeat(self):
+        while True:
+            started = time.perf_counter()
+            self._beat = started
+            await asyncio.sleep(self.interval)
+
+            late = time.perf_counter() - started - self.interval
+            LOOP_LAG.observe(late)
+            stall, self._stall = self._stall, None
+            if stall is not None:
+                stall['seconds'] = late
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval / 2)
+
+            # The heartbeat is only due back `interval` after it beat
+            beat = self._beat
+            if time.perf_counter() - beat - self.interval < self.threshold or beat == reported:
+                continue
+            reported = beat
+
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            stack = traceback.extract_stack(frame)
+            task = asyncio.current_task(self._loop)
+            where = self.commands.get(task) if task is not None else None
+            if where is None:
+                where = next((entry.name for entry in reversed(stack) if entry.filename == __file__), '<unknown>')
+            else:
+                where = 'm.' + where
+
+            self._stall = stall = {'at': time.time(), 'where': where, 'seconds': None, 'stack': stack}
+            self.stalls.append(stall)
+            STALLS.inc(where=where)
+            print('Event loop blocked for over {:.2f}s in {}:\n{}'.format(
+                self.threshold, where, ''.join(traceback.format_list(stack[-8:]))), file=sys.stderr)
+
+
+class SamplingProfiler:
+    """Samples every thread's stack, writing folded stacks for flamegraph.pl or speedscope."""
+
+    def __init__(self, directory: str = 'profiles', interval: float = 0.005):
+        self.directory = directory
+        self.interval = interval
+        self.running = threading.Lock()
+
+    def run(self, seconds: float):
+        """Blocks for `seconds` sampling, returns the file written and the sample counts."""
+
+        if not self.running.acquire(blocking=False):
+            raise RuntimeError('A profile is already being taken.')
+
+        try:
+            counts = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append('{} ({}:{})'.format(_frame_name(code), os.path.basename(code.co_filename),
+                                                        code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[';'.join(reversed(stack))] += 1
+
+                time.sleep(self.interval)
+        finally:
+            self.running.release()
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+        with open(path, 'w') as f:
+            f.writelines('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+        return path, counts
+
+
+watchdog = LoopWatchdog()
+profiler = SamplingProfiler()
+
+
+def _sizeof(obj, _seen=None):
+    # Rough deep size of a youtube_dl info dict, good enough for a memory cap
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, _seen) + _sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(i, _seen) for i in obj)
+    return size
+
+
+class InfoCache:
+    """LRU cache of resolved youtube_dl info dicts.
+
+    Searches map to a `webpage_url`, and each `webpage_url` maps to its
+    processed info. Processed info carries a stream `url` that expires
+    upstream, so it gets a shorter TTL than the search results.
+    """
+
+    # Bulky fields nothing downstream reads, dropped before caching
+    TRIM_KEYS = ('formats', 'requested_formats', 'thumbnails', 'subtitles', 'automatic_captions', 'http_headers')
+
+    def __init__(self, *, search_ttl: float = 6 * 60 * 60, stream_ttl: float = 60 * 60,
+                 max_bytes: int = 32 * 1024 * 1024, expire_margin: float = 5 * 60):
+        self.search_ttl = search_ttl
+        self.stream_ttl = stream_ttl
+        self.max_bytes = max_bytes
+        self.expire_margin = expire_margin
+
+        # key -> (expires_at, size, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    @staticmethod
+    def normalize(search: str):
+        search = search.strip()
+        # URLs are case sensitive (video IDs), free-text searches are not
+        if urllib.parse.urlsplit(search).scheme in ('http', 'https'):
+            return search
+        return ' '.join(search.casefold().split())
+
+    @staticmethod
+    def stream_expires(info: dict):
+        # YouTube stream URLs carry their own expiry as a unix timestamp
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(info.get('url') or '').query)
+        try:
+            return int(query['expire'][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    def stream_ttl_for(self, info: dict):
+        expires = self.stream_expires(info)
+        if expires is None:
+            return self.stream_ttl
+        return min(self.stream_ttl, expires - time.time() - self.expire_margin)
+
+    def get_search(self, search: str):
+        return self._get('search', self.normalize(search))
+
+    def put_search(self, search: str, webpage_url: str):
+        self._put('search', self.normalize(search), webpage_url, self.search_ttl)
+
+    def get_info(self, webpage_url: str):
+        return self._get('info', webpage_url)
+
+    def put_info(self, webpage_url: str, info: dict):
+        info = {k: v for k, v in info.items() if k not in self.TRIM_KEYS}
+        self._put('info', webpage_url, info, self.stream_ttl_for(info))
+        return info
+
+    def invalidate(self, webpage_url: str):
+        self._pop(('info', webpage_url))
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+        }
+
+    def _get(self, kind: str, key: str):
+        entry = self._entries.get((kind, key))
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self._pop((kind, key))
+            self.misses[kind] += 1
+            return None
+
+        self._entries.move_to_end((kind, key))
+        self.hits[kind] += 1
+        return entry[2]
+
+    def _put(self, kind: str, key: str, value, ttl: float):
+        if ttl <= 0:
+            return
+
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        self._pop((kind, key))
+        self._entries[(kind, key)] = (time.monotonic() + ttl, size, value)
+        self._size += size
+
+        while self._size > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self._size -= evicted
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call."""
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func, *args):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self._calls[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+
+        # Shielded, so one waiter being cancelled doesn't cancel the others' work
+        return await asyncio.shield(future)
+
+    def _done(self, key, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not future.cancelled():
+            future.exception()
+
+
+def _extract_info(url: str, process: bool = True, max_entries: int = None):
+    # Module level so it can be pickled into a process pool worker
+    info = YTDLSource.get_ytdl().extract_info(url, download=False, process=process)
+
+    # Unprocessed searches and playlists yield their entries lazily, and each
+    # page fetched is a blocking request, so consume them here in the worker.
+    if info is not None and 'entries' in info and not isinstance(info['entries'], list):
+        info['entries'] = list(itertools.islice(info['entries'], max_entries))
+
+    return info
+
+
+class ExtractionPool:
+    """Bounded executor for youtube_dl extraction.
+
+    Jobs are queued per guild and the workers serve guilds round-robin, so a
+    guild spamming `m.play` only waits behind itself. Set `processes` to run
+    extraction in worker processes, keeping youtube_dl's parsing off the
+    GIL that the voice threads need.
+    """
+
+    def __init__(self, size: int = 4, *, max_pending: int = 64, max_pending_per_guild: int = 8,
+                 processes: bool = False):
+        self.size = size
+        self.max_pending = max_pending
+        self.max_pending_per_guild = max_pending_per_guild
+        self.processes = processes
+
+        # guild_id -> deque of (future, func, args), guild at the front is served next
+        self._queues = collections.OrderedDict()
+        self._pending = 0
+        self._ready = None
+        self._workers = []
+        self._executor = None
+
+    def __len__(self):
+        return self._pending
+
+    def start(self):
+        if self.processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.size)
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.size,
+                                                                   thread_name_prefix='ytdl')
+
+        self._ready = asyncio.Semaphore(0)
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.size)]
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+        for queue in self._queues.values():
+            for future, _, _ in queue:
+                future.cancel()
+        self._queues.clear()
+        self._pending = 0
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def submit(self, guild_id: int, func, *args):
+        if not self._workers:
+            self.start()
+
+        if self._pending >= self.max_pending:
+            raise YTDLError('Too many songs are being looked up right now, try again in a moment.')
+
+        queue = self._queues.setdefault(guild_id, collections.deque())
+        if len(queue) >= self.max_pending_per_guild:
+            raise YTDLError('This server already has {} songs being looked up, '
+                            'wait for those to finish first.'.format(len(queue)))
+
+        future = asyncio.get_event_loop().create_future()
+        queue.append((future, func, args))
+        self._pending += 1
+        self._ready.release()
+
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await self._ready.acquire()
+
+            guild_id, queue = next(iter(self._queues.items()))
+            future, func, args = queue.popleft()
+            self._pending -= 1
+
+            # Send the guild to the back of the line
+            if queue:
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+
+            if future.cancelled():
+                continue
+
+            try:
+                result = await loop.run_in_executor(self._executor, functools.partial(func, *args))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
+def _download_audio(url: str, directory: str):
+    options = dict(YTDLSource.YTDL_OPTIONS,
+                   format='bestaudio[acodec=opus]',
+                   outtmpl=os.path.join(directory, '%(id)s.%(ext)s'))
+
+    with youtube_dl.YoutubeDL(options) as ytdl:
+        info = ytdl.extract_info(url, download=True)
+        return ytdl.prepare_filename(info)
+
+
+def _extract_playlist(url: str, start: int, count: int):
+    # extract_flat keeps the entries as bare URL results, and the start/end
+    # options make youtube_dl only walk the playlist as far as this chunk
+    options = dict(YTDLSource.PLAYLIST_OPTIONS, playliststart=start + 1, playlistend=start + count)
+
+    with youtube_dl.YoutubeDL(options) as ytdl:
+        return ytdl.extract_info(url, download=False)
+
+
+class AudioCache:
+    """Opt-in on-disk cache for frequently played tracks.
+
+    A track is downloaded as Opus once it has been played `threshold`
+    times, then played from disk. Files live under `directory`, which is
+    kept below `max_bytes` by evicting the least recently played tracks.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory: str = 'audio_cache', *, enabled: bool = False, threshold: int = 3,
+                 max_bytes: int = 2 * 1024 ** 3, max_counted: int = 10000):
+        self.directory = directory
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.max_counted = max_counted
+
+        self.plays = collections.Counter()
+        # webpage_url -> {'file': ..., 'size': ...}, least recently played first
+        self._index = None
+        self._size = 0
+        self._downloading = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio-cache')
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def size(self):
+        if self._index is None:
+            self._load()
+        return self._size
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._load()
+        return self._index
+
+    def get(self, webpage_url: str):
+        """Returns the local file for a track, or None if it isn't cached."""
+
+        if not self.enabled:
+            return None
+
+        entry = self.index.get(webpage_url)
+        if entry is None:
+            return None
+
+        path = os.path.join(self.directory, entry['file'])
+        if not os.path.exists(path):
+            self._evict(webpage_url)
+            return None
+
+        self.index.move_to_end(webpage_url)
+        return path
+
+    def record_play(self, source: 'YTDLSource'):
+        if not self.enabled or source.url in self.index or source.url in self._downloading:
+            return
+
+        # Only Opus streams are cached, so cached files can always be copied as is
+        if source.data.get('acodec') != 'opus':
+            return
+
+        self.plays[source.url] += 1
+        if self.plays[source.url] >= self.threshold:
+            del self.plays[source.url]
+            asyncio.ensure_future(self.download(source.url, source.data))
+        elif len(self.plays) > self.max_counted:
+            self.plays = collections.Counter(dict(self.plays.most_common(self.max_counted // 2)))
+
+    def get_info(self, webpage_url: str):
+        if self.get(webpage_url) is None:
+            return None
+        return self.index[webpage_url]['info']
+
+    async def download(self, webpage_url: str, info: dict):
+        self._downloading.add(webpage_url)
+        try:
+            loop = asyncio.get_event_loop()
+            partial = functools.partial(_download_audio, webpage_url, self.directory)
+            path = await loop.run_in_executor(self._executor, partial)
+        except youtube_dl.utils.DownloadError:
+            return
+        finally:
+            self._downloading.discard(webpage_url)
+
+        size = os.path.getsize(path)
+        self.index[webpage_url] = {'file': os.path.basename(path), 'size': size, 'info': info}
+        self._size += size
+
+        while self._size > self.max_bytes and len(self._index) > 1:
+            self._evict(next(iter(self._index)))
+        self._save()
+
+    def _evict(self, webpage_url: str):
+        entry = self.index.pop(webpage_url)
+        self._size -= entry['size']
+
+        try:
+            os.remove(os.path.join(self.directory, entry['file']))
+        except FileNotFoundError:
+            pass
+
+    def _load(self):
+        self._index = collections.OrderedDict()
+        self._size = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        for webpage_url, entry in entries:
+            if os.path.exists(os.path.join(self.directory, entry['file'])):
+                self._index[webpage_url] = entry
+                self._size += entry['size']
+
+    def _save(self):
+        # Written in LRU order, and swapped in atomically so a crash can't truncate it
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(list(self._index.items()), f)
+        os.replace(path + '.tmp', path)
+
+
+class FFmpegPool:
+    """Caps the FFmpeg processes pre-spawned for upcoming songs, across every guild.
+
+    A warm process has already started, probed its input and connected, so
+    its song's first frame comes right away. Each one holds a connection and
+    a few MB though, so past `size` the oldest is shut down again and its
+    song starts cold. `check` shuts down the ones that died or went stale.
+    """
+
+    def __init__(self, size: int = 32):
+        self.size = size
+        # id(source) -> source, oldest first
+        self.warm = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.warm)
+
+    def add(self, source: 'YTDLSource'):
+        self.warm.pop(id(source), None)
+        self.warm[id(source)] = source
+
+        while len(self.warm) > self.size:
+            _, oldest = self.warm.popitem(last=False)
+            oldest.cool()
+            FFMPEG_WARM.inc(outcome='evicted')
+
+    def discard(self, source: 'YTDLSource'):
+        return self.warm.pop(id(source), None) is not None
+
+    def check(self):
+        for key, source in list(self.warm.items()):
+            if not source.healthy:
+                self.warm.pop(key, None)
+                source.cool()
+                FFMPEG_WARM.inc(outcome='unhealthy')
+
+
+class YTDLSource(discord.AudioSource):
     YTDL_OPTIONS = {
         'format': 'bestaudio/best',
         'extractaudio': True,
@@ -38,45 +867,383 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'source_address': '0.0.0.0',
     }
 
+    PLAYLIST_OPTIONS = dict(YTDL_OPTIONS, noplaylist=False, extract_flat='in_playlist')
+
     FFMPEG_OPTIONS = {
         'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
         'options': '-vn',
-        'executable':  imageio_ffmpeg.get_ffmpeg_exe()
     }
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
-
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
+    # 'opus' has FFmpeg hand discord.py ready Opus packets. Streams that already
+    # are Opus are copied as is, but only at exactly 100% volume, which is the
+    # default, anything else goes through FFmpeg's volume filter and libopus.
+    # 'pcm' decodes to PCM and scales the volume in Python, and is used when
+    # FFmpegOpusAudio is missing.
+    PLAYBACK_MODE = 'opus'
+
+    # How many unprocessed entries a search looks through for a playable one
+    SEARCH_ENTRIES = 5
+    # How many results m.search offers to pick from
+    SEARCH_RESULTS = 5
+
+    # Playlists are read this many entries at a time, up to a maximum
+    PLAYLIST_CHUNK = 50
+    PLAYLIST_MAX = 500
+
+    # FFmpeg processes older than this have likely had their idle HTTP
+    # connection dropped, so they are respawned before playing
+    WARM_MAX_AGE = 60
+
+    # Built on first use, see get_ytdl and ffmpeg_executable
+    _ytdl = None
+    _ytdl_lock = threading.Lock()
+    _ffmpeg = None
+
+    cache = InfoCache()
+    inflight = SingleFlight()
+    pool = ExtractionPool()
+    audio_cache = AudioCache()
+    ffmpeg_pool = FFmpegPool()
+
+    # The only info fields a queued source keeps, the rest (description,
+    # tags, ...) can be several KB per song and is never shown
+    DATA_KEYS = ('title', 'uploader', 'uploader_url', 'upload_date', 'thumbnail', 'duration', 'webpage_url',
+                 'view_count', 'like_count', 'dislike_count', 'url', 'acodec')
+
+    def __init__(self, ctx: commands.Context, source: discord.AudioSource = None, *, data: dict, volume: float = None,
+                 offset: float = 0.0):
+        self.original = None
+        self._volume = max(self.default_volume() if volume is None else volume, 0.0)
 
         self.requester = ctx.author
         self.channel = ctx.channel
-        self.data = data
+        self.data = data = self.slim(data)
 
         self.uploader = data.get('uploader')
         self.uploader_url = data.get('uploader_url')
         date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
+        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4] if date else None
         self.title = data.get('title')
         self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
+        # Live streams and premieres have no duration
+        self.duration = self.parse_duration(int(data.get('duration') or 0)) or 'Unknown'
         self.url = data.get('webpage_url')
         self.views = data.get('view_count')
         self.likes = data.get('like_count')
         self.dislikes = data.get('dislike_count')
         self.stream_url = data.get('url')
+        self.local_file = self.audio_cache.get(self.url)
+        self.length = int(data.get('duration') or 0)
+
+        self.resolved_at = time.monotonic()
+        self.spawned_at = time.monotonic()
+
+        # Playback position is the offset FFmpeg was started at plus the
+        # 20ms frames read since
+        self.start_offset = offset
+        self.frames = 0
+        # Set once FFmpeg runs out of audio, rather than playback being stopped
+        self.ended = False
+        # (since, perf_counter, start) the wait for the first frame is measured from
+        self.first_frame = None
+
+        # FFmpeg is only started by prepare(), songs deep in the queue don't hold a process
+        self.original = source
 
     def __str__(self):
         return '**{0.title}** by **{0.uploader}**'.format(self)
 
     @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
-        loop = loop or asyncio.get_event_loop()
+    def get_ytdl(cls):
+        if cls._ytdl is None:
+            with cls._ytdl_lock:
+                if cls._ytdl is None:
+                    cls._ytdl = youtube_dl.YoutubeDL(cls.YTDL_OPTIONS)
+        return cls._ytdl
+
+    @classmethod
+    def ffmpeg_executable(cls):
+        if cls._ffmpeg is None:
+            cls._ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+        return cls._ffmpeg
 
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+    @classmethod
+    def warm(cls):
+        """Loads youtube_dl and finds FFmpeg ahead of the first song. Blocks, run it in an executor."""
+
+        cls.get_ytdl()
+        cls.ffmpeg_executable()
+
+    @classmethod
+    def opus_playback(cls):
+        return cls.PLAYBACK_MODE == 'opus' and hasattr(discord, 'FFmpegOpusAudio')
+
+    @classmethod
+    def default_volume(cls):
+        # Full volume lets Opus streams be copied rather than re-encoded,
+        # turning it down is what costs the re-encode
+        return 1.0 if cls.opus_playback() else 0.5
+
+    @classmethod
+    def slim(cls, data: dict):
+        return {key: data[key] for key in cls.DATA_KEYS if key in data}
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        value = max(value, 0.0)
+        if value == self._volume:
+            return
+
+        self._volume = value
+        # The Opus path bakes the volume into the FFmpeg filter graph
+        if self.original is not None and self.original.is_opus():
+            self.spawn(self.position)
+
+    @property
+    def position(self):
+        return self.start_offset + self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    @property
+    def passthrough(self):
+        return self.data.get('acodec') == 'opus' and self._volume == 1.0
+
+    def spawn(self, offset: float = 0.0):
+        # The reconnect options only apply to (and are only accepted for) HTTP inputs
+        before_options = '' if self.local_file else self.FFMPEG_OPTIONS['before_options']
+        if offset:
+            before_options += ' -ss {:.2f}'.format(offset)
+
+        if self.opus_playback():
+            options = self.FFMPEG_OPTIONS['options']
+            if not self.passthrough:
+                options += ' -filter:a volume={:.2f}'.format(min(self._volume, 2.0))
+
+            # discord.py copies the stream when told its codec already is
+            # 'opus', passing it codec='copy' would make it re-encode instead
+            with FFMPEG_SPAWN_SECONDS.time(mode='copy' if self.passthrough else 'opus'):
+                source = discord.FFmpegOpusAudio(self.local_file or self.stream_url,
+                                                 codec='opus' if self.passthrough else None,
+                                                 executable=self.ffmpeg_executable(),
+                                                 before_options=before_options, options=options)
+        else:
+            with FFMPEG_SPAWN_SECONDS.time(mode='pcm'):
+                source = discord.FFmpegPCMAudio(self.local_file or self.stream_url, executable=self.ffmpeg_executable(),
+                                                **dict(self.FFMPEG_OPTIONS, before_options=before_options))
+
+        original = self.original
+        self.original = source
+        self.spawned_at = time.monotonic()
+        self.start_offset = offset
+        self.frames = 0
+        self.ended = False
+
+        if original is not None:
+            self._close(original)
+
+    @staticmethod
+    def _close(original: discord.AudioSource):
+        try:
+            original.cleanup()
+        except ValueError:
+            # The player thread cleans up the source it finished with, racing
+            # anyone stopping or respawning it to reap the process
+            pass
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def read(self):
+        original = self.original
+        try:
+            data = original.read()
+        except (discord.oggparse.OggError, ValueError):
+            # Cleaned up mid-read, the Opus path fails to parse the cut off
+            # page and the PCM path reads from the closed pipe
+            data = b''
+
+        if not data and original is not self.original:
+            # Respawned while the player thread was reading, carry on with
+            # the new process instead of ending the song
+            original = self.original
+            data = original.read()
+
+        if data:
+            self.frames += 1
+            if self.first_frame is not None:
+                since, started, start = self.first_frame
+                self.first_frame = None
+                FIRST_FRAME_SECONDS.observe(time.perf_counter() - started, since=since, start=start)
+
+            if not original.is_opus():
+                data = audioop.mul(data, 2, min(self._volume, 2.0))
+        else:
+            self.ended = True
+        return data
+
+    def cleanup(self):
+        self.ffmpeg_pool.discard(self)
+        if self.original is not None:
+            self._close(self.original)
+
+    def cool(self):
+        """Shuts FFmpeg down until the next prepare()."""
+
+        original, self.original = self.original, None
+        if original is not None:
+            self._close(original)
+
+    @property
+    def healthy(self):
+        """Whether FFmpeg is running and, when streaming, connected recently enough to still be."""
+
+        process = getattr(self.original, '_process', None)
+        if process is None or process.poll() is not None:
+            return False
+        return bool(self.local_file) or time.monotonic() - self.spawned_at < self.WARM_MAX_AGE
+
+    @property
+    def stream_expired(self):
+        expires = self.cache.stream_expires(self.data)
+        if expires is not None:
+            return expires - time.time() < self.cache.expire_margin
+        return time.monotonic() - self.resolved_at > self.cache.stream_ttl
+
+    async def prepare(self, upcoming: bool = False):
+        """Makes sure the stream URL is still valid and FFmpeg is running and freshly connected.
+
+        `upcoming` songs keep their process in `ffmpeg_pool` until they play.
+        """
+
+        # The track may have been cached, or evicted, while it sat in the queue
+        local_file = self.audio_cache.get(self.url)
+        switched = local_file != self.local_file
+        self.local_file = local_file
+
+        if not self.local_file and self.stream_expired:
+            await self.refresh()
+            fresh = False
+        else:
+            fresh = not switched and self.healthy
+
+        if not fresh:
+            # Spawning the new process also gets the FFmpeg startup and HTTP
+            # connect done ahead of playback
+            self.spawn(self.start_offset)
+
+        if upcoming:
+            self.ffmpeg_pool.add(self)
+        elif self.ffmpeg_pool.discard(self):
+            FFMPEG_WARM.inc(outcome='played' if fresh else 'unhealthy')
+
+    async def seek(self, offset: float):
+        """Restarts FFmpeg at `offset` seconds, reusing the stream URL unless it expired."""
+
+        self.local_file = self.audio_cache.get(self.url)
+        if not self.local_file and self.stream_expired:
+            await self.refresh()
+
+        self.spawn(offset)
+
+    async def refresh(self):
+        self.cache.invalidate(self.url)
+        key = ('info', self.url)
+        self.data = self.slim(await self.inflight.do(key, self._process, self.url, self.channel.guild.id))
+        self.stream_url = self.data.get('url')
+        self.resolved_at = time.monotonic()
+
+    @classmethod
+    async def create_source(cls, ctx: commands.Context, search: str):
+        webpage_url = cls.cache.get_search(search)
+        if webpage_url is None:
+            key = ('search', cls.cache.normalize(search))
+            webpage_url = await cls.inflight.do(key, cls._search, search, ctx.guild.id)
+
+        return await cls.from_url(ctx, webpage_url)
+
+    @classmethod
+    async def from_url(cls, ctx: commands.Context, webpage_url: str, offset: float = 0.0):
+        # Tracks cached on disk don't need a stream URL, just their metadata
+        info = cls.cache.get_info(webpage_url) or cls.audio_cache.get_info(webpage_url)
+        if info is None:
+            info = await cls.inflight.do(('info', webpage_url), cls._process, webpage_url, ctx.guild.id)
+
+        return cls(ctx, data=info, offset=offset)
+
+    @classmethod
+    async def iter_playlist(cls, ctx: commands.Context, url: str):
+        """Yields `(title, entries)` for each chunk of a playlist's flat entries."""
+
+        start = 0
+        while start < cls.PLAYLIST_MAX:
+            count = min(cls.PLAYLIST_CHUNK, cls.PLAYLIST_MAX - start)
+            with EXTRACT_SECONDS.time(stage='playlist'):
+                data = await cls.pool.submit(ctx.guild.id, _extract_playlist, url, start, count)
+
+            if data is None:
+                raise YTDLError('Couldn\'t fetch `{}`'.format(url))
+
+            if 'entries' not in data:
+                # Not a playlist, just a single song
+                yield data.get('title'), [data]
+                return
+
+            entries = [entry for entry in data['entries'] if entry]
+            yield data.get('title'), entries
+
+            if len(data['entries']) < count:
+                return
+            start += count
+
+    @staticmethod
+    def entry_url(entry: dict):
+        url = entry.get('webpage_url') or entry.get('url')
+        # Flat YouTube entries only carry the video ID
+        if entry.get('ie_key') == 'Youtube' and not url.startswith('http'):
+            url = 'https://www.youtube.com/watch?v={}'.format(url)
+        return url
+
+    @classmethod
+    async def search_results(cls, ctx: commands.Context, search: str):
+        """The top `SEARCH_RESULTS` YouTube matches for `search` as flat entries, from a single search."""
+
+        query = 'ytsearch{}:{}'.format(cls.SEARCH_RESULTS, search)
+        with EXTRACT_SECONDS.time(stage='search'):
+            data = await cls.pool.submit(ctx.guild.id, _extract_info, query, False, cls.SEARCH_RESULTS)
+
+        entries = [entry for entry in (data or {}).get('entries', ()) if entry]
+        if not entries:
+            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        results = [{'webpage_url': cls.entry_url(entry), 'title': entry.get('title'),
+                    'duration': entry.get('duration'), 'uploader': entry.get('uploader')} for entry in entries]
+
+        # Search results usually come with their title and duration, the ones
+        # that don't are looked up together, which also warms the info cache
+        # for whichever gets picked
+        missing = [result for result in results if not result['title'] or result['duration'] is None]
+        infos = await asyncio.gather(*(cls._info(result['webpage_url'], ctx.guild.id) for result in missing),
+                                     return_exceptions=True)
+        for result, info in zip(missing, infos):
+            if isinstance(info, dict):
+                result.update(title=info.get('title'), duration=info.get('duration'), uploader=info.get('uploader'))
+
+        return results
+
+    @classmethod
+    async def _info(cls, webpage_url: str, guild_id: int):
+        info = cls.cache.get_info(webpage_url)
+        if info is None:
+            info = await cls.inflight.do(('info', webpage_url), cls._process, webpage_url, guild_id)
+        return info
+
+    @classmethod
+    async def _search(cls, search: str, guild_id: int):
+        with EXTRACT_SECONDS.time(stage='search'):
+            data = await cls.pool.submit(guild_id, _extract_info, search, False, cls.SEARCH_ENTRIES)
 
         if data is None:
             raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
@@ -94,8 +1261,13 @@ class YTDLSource(discord.PCMVolumeTransformer):
                 raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
 
         webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        cls.cache.put_search(search, webpage_url)
+        return webpage_url
+
+    @classmethod
+    async def _process(cls, webpage_url: str, guild_id: int):
+        with EXTRACT_SECONDS.time(stage='process'):
+            processed_info = await cls.pool.submit(guild_id, _extract_info, webpage_url)
 
         if processed_info is None:
             raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
@@ -110,7 +1282,7 @@ class YTDLSource(discord.PCMVolumeTransformer):
                 except IndexError:
                     raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+        return cls.cache.put_info(webpage_url, info)
 
     @staticmethod
     def parse_duration(duration: int):
@@ -130,15 +1302,108 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
         return ', '.join(duration)
 
+    @staticmethod
+    def parse_timestamp(timestamp: str):
+        """Parses `[[hh:]mm:]ss`, keeping a leading sign, into seconds."""
+
+        sign = -1 if timestamp.startswith('-') else 1
+        parts = timestamp.lstrip('+-').split(':')
+        if not 1 <= len(parts) <= 3:
+            raise ValueError(timestamp)
+
+        seconds = 0.0
+        for part in parts:
+            if not part.replace('.', '', 1).isdigit():
+                raise ValueError(timestamp)
+            seconds = seconds * 60 + float(part)
+        return sign * seconds
+
+
+class StandInContext:
+    """Stands in for the commands.Context a song was queued from, or a restored player was created from.
+
+    Keeps only what looking the song up later needs, not the message and everything it references.
+    """
+
+    __slots__ = ('guild', 'channel', 'author')
+
+    def __init__(self, guild: discord.Guild, channel: discord.TextChannel, author: discord.Member):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+
+    @classmethod
+    def of(cls, ctx: commands.Context):
+        return ctx if isinstance(ctx, cls) else cls(ctx.guild, ctx.channel, ctx.author)
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
 
 class Song:
-    __slots__ = ('source', 'requester')
+    __slots__ = ('source', 'requester', 'requested_at', '_ctx', '_title', '_url', '_length', '_offset', '_embed')
+
+    resolving = SingleFlight()
 
     def __init__(self, source: YTDLSource):
         self.source = source
         self.requester = source.requester
+        # When the command queueing it into an idle player started
+        self.requested_at = None
+        self._embed = None
+
+    @classmethod
+    def placeholder(cls, ctx: commands.Context, entry: dict, offset: float = 0.0):
+        """A song known only by a flat playlist entry, resolved once it nears the head of the queue."""
+
+        self = cls.__new__(cls)
+        self.source = None
+        self.requester = ctx.author
+        self.requested_at = None
+        self._ctx = StandInContext.of(ctx)
+        self._title = entry.get('title')
+        self._url = YTDLSource.entry_url(entry)
+        self._length = int(entry.get('duration') or 0)
+        self._offset = offset
+        self._embed = None
+        return self
+
+    @property
+    def title(self):
+        return self.source.title if self.source else self._title or self._url
+
+    @property
+    def url(self):
+        return self.source.url if self.source else self._url
+
+    @property
+    def length(self):
+        return self.source.length if self.source else self._length
+
+    def approx_size(self):
+        # Only what the song owns, not the discord objects it points at
+        if self.source is None:
+            return (sys.getsizeof(self) + sys.getsizeof(self._ctx) + sys.getsizeof(self._title)
+                    + sys.getsizeof(self._url))
+        return sys.getsizeof(self) + sys.getsizeof(self.source) + _sizeof(self.source.data)
+
+    async def resolve(self):
+        if self.source is None:
+            # Shared, so the player and the prefetcher don't both spawn a source
+            self.source = await self.resolving.do(id(self), YTDLSource.from_url, self._ctx, self._url, self._offset)
+            self._ctx = None
+
+        return self.source
+
+    def cleanup(self):
+        if self.source is not None:
+            self.source.cleanup()
 
     def create_embed(self):
+        # Nothing shown changes once the song is resolved, so it's only built once
+        if self._embed is not None:
+            return self._embed
+
         embed = (discord.Embed(title='Now playing',
                                description='```css\n{0.source.title}\n```'.format(self),
                                color=discord.Color.blurple())
@@ -148,33 +1413,396 @@ class Song:
                  .add_field(name='URL', value='[Click]({0.source.url})'.format(self))
                  .set_thumbnail(url=self.source.thumbnail))
 
+        self._embed = embed
         return embed
 
 
-class SongQueue(asyncio.Queue):
+class _QueueNode:
+    # Node of an implicit treap: ordered by position rather than by key, with
+    # subtree sizes for indexing and subtree lengths for the total duration
+    __slots__ = ('song', 'priority', 'left', 'right', 'size', 'length')
+
+    def __init__(self, song: Song):
+        self.song = song
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+        self.length = song.length
+
+    def update(self):
+        self.size = 1
+        self.length = self.song.length
+        if self.left:
+            self.size += self.left.size
+            self.length += self.left.length
+        if self.right:
+            self.size += self.right.size
+            self.length += self.right.length
+
+
+def _split(node: _QueueNode, index: int):
+    # Splits into the first `index` songs and the rest
+    if node is None:
+        return None, None
+
+    left_size = node.left.size if node.left else 0
+    if index <= left_size:
+        left, node.left = _split(node.left, index)
+        node.update()
+        return left, node
+    else:
+        node.right, right = _split(node.right, index - left_size - 1)
+        node.update()
+        return node, right
+
+
+def _merge(left: _QueueNode, right: _QueueNode):
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        right.update()
+        return right
+
+
+class SongQueue:
+    """Song queue with O(log n) indexing, insertion, removal and moves.
+
+    `get` waits for a song like `asyncio.Queue.get`, but the songs live in
+    an implicit treap, so reaching into the middle of a queue of thousands
+    of playlist songs doesn't walk a deque.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._getters = collections.deque()
+        # Bumped on every change, so readers can tell when their view is stale
+        self.version = 0
+
     def __getitem__(self, item):
         if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+            start, stop, step = item.indices(len(self))
+            if step < 0:
+                # Walking backwards isn't worth a special case
+                return list(self)[item]
+            songs = list(self._iter_from(start, stop - start)) if stop > start else []
+            return songs[::step] if step != 1 else songs
+
+        return self._node_at(self._index(item)).song
 
     def __iter__(self):
-        return self._queue.__iter__()
+        return self._iter_from(0, len(self))
 
     def __len__(self):
-        return self.qsize()
+        return self._root.size if self._root else 0
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return self._root is None
+
+    @property
+    def duration(self):
+        """Total length of the queued songs, in seconds."""
+
+        return self._root.length if self._root else 0
+
+    async def put(self, song: Song):
+        self.put_nowait(song)
+
+    def put_nowait(self, song: Song):
+        self._root = _merge(self._root, _QueueNode(song))
+        self.version += 1
+        self._wakeup_next()
+
+    async def get(self):
+        while self._root is None:
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                # We may have been woken up for a song we now won't take
+                if self._root is not None and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if self._root is None:
+            raise asyncio.QueueEmpty
+
+        return self.remove(0)
+
+    def insert(self, index: int, song: Song):
+        index = max(0, min(index, len(self)))
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, _QueueNode(song)), right)
+        self.version += 1
+        self._wakeup_next()
+
+    def insert_next(self, song: Song):
+        self.insert(0, song)
+
+    def remove(self, index: int):
+        index = self._index(index)
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._root = _merge(left, right)
+        self.version += 1
+        return node.song
+
+    def move(self, index: int, destination: int):
+        self.insert(destination, self.remove(index))
 
     def clear(self):
-        self._queue.clear()
+        self._root = None
+        self.version += 1
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        songs = list(self)
+        random.shuffle(songs)
+
+        self._root = None
+        for song in songs:
+            self._root = _merge(self._root, _QueueNode(song))
+        self.version += 1
+
+    def _index(self, index: int):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        return index
+
+    def _node_at(self, index: int):
+        node = self._root
+        while True:
+            left_size = node.left.size if node.left else 0
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+
+    def _iter_from(self, start: int, count: int):
+        # In-order walk that descends straight to `start`, O(log n + count)
+        stack = []
+        node = self._root
+        while node:
+            left_size = node.left.size if node.left else 0
+            if start < left_size:
+                stack.append(node)
+                node = node.left
+            elif start == left_size:
+                stack.append(node)
+                break
+            else:
+                start -= left_size + 1
+                node = node.right
+
+        while stack and count > 0:
+            node = stack.pop()
+            yield node.song
+            count -= 1
+
+            node = node.right
+            while node:
+                stack.append(node)
+                node = node.left
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+
+class Outbox:
+    """Sends a channel's messages one at a time, ahead of Discord's rate limits.
+
+    Replies to commands go out first. Notifications queued meanwhile are
+    joined into as few messages as they fit in, and the player's status
+    embed is edited in place while it's still the channel's last message.
+    """
+
+    # How long to wait for a burst of notifications to finish before sending it
+    LINGER = 0.5
+    # Idle outboxes are dropped after this long, along with their status message
+    IDLE_TIMEOUT = 10 * 60
+
+    # channel_id -> Outbox
+    channels = {}
+    # Message counts, and the seconds spent queued here and inside discord.py's
+    # rate limiter, across every channel
+    stats = collections.Counter()
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+
+        self.replies = collections.deque()
+        self.notices = collections.deque()
+        self.status_embed = None
+        self.status_message = None
+
+        self.replied = asyncio.Event()
+        self.task = None
+        self.last_active = time.monotonic()
 
-    def remove(self, index: int):
-        del self._queue[index]
+    @classmethod
+    def of(cls, channel: discord.abc.Messageable):
+        outbox = cls.channels.get(channel.id)
+        if outbox is None:
+            outbox = cls.channels[channel.id] = cls(channel)
+        return outbox
+
+    @classmethod
+    def prune(cls):
+        now = time.monotonic()
+        for channel_id, outbox in list(cls.channels.items()):
+            if outbox.task is None and now - outbox.last_active > cls.IDLE_TIMEOUT:
+                del cls.channels[channel_id]
+
+    async def send(self, *args, **kwargs):
+        """Sends a reply ahead of any pending notifications and returns the message."""
+
+        future = asyncio.get_event_loop().create_future()
+        self.replies.append((future, time.monotonic(), args, kwargs))
+        self.replied.set()
+        self._wake()
+        return await future
+
+    def notify(self, content: str):
+        self.notices.append((time.monotonic(), content))
+        self._wake()
+
+    def status(self, embed: discord.Embed):
+        # Only the latest status is worth sending
+        if self.status_embed is not None:
+            self.stats['coalesced'] += 1
+        self.status_embed = (time.monotonic(), embed)
+        self._wake()
+
+    def _wake(self):
+        self.last_active = time.monotonic()
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        lingered = False
+        try:
+            while self.replies or self.notices or self.status_embed:
+                if self.replies:
+                    await self._send_reply(*self.replies.popleft())
+                elif not lingered:
+                    # Replies cut the wait short
+                    self.replied.clear()
+                    try:
+                        await asyncio.wait_for(self.replied.wait(), self.LINGER)
+                    except asyncio.TimeoutError:
+                        pass
+                    lingered = True
+                elif self.notices:
+                    await self._send_notices()
+                else:
+                    await self._send_status()
+        finally:
+            self.task = None
+
+    async def _send_reply(self, future: asyncio.Future, queued: float, args: tuple, kwargs: dict):
+        if future.cancelled():
+            return
+
+        try:
+            message = await self._call(queued, self.channel.send(*args, **kwargs))
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+        else:
+            self.stats['replies'] += 1
+            if not future.cancelled():
+                future.set_result(message)
+
+    async def _send_notices(self):
+        queued = self.notices[0][0]
+        batch = []
+        size = 0
+        while self.notices and (not batch or size + len(self.notices[0][1]) < 2000):
+            content = self.notices.popleft()[1]
+            batch.append(content)
+            size += len(content) + 1
+
+        self.stats['notices'] += len(batch)
+        self.stats['coalesced'] += len(batch) - 1
+        try:
+            await self._call(queued, self.channel.send('\n'.join(batch)[:2000]))
+        except discord.HTTPException:
+            self.stats['errors'] += 1
+
+    async def _send_status(self):
+        queued, embed = self.status_embed
+        self.status_embed = None
+
+        message = self.status_message
+        try:
+            if message is not None and self.channel.last_message_id == message.id:
+                await self._call(queued, message.edit(embed=embed))
+                self.stats['edits'] += 1
+            else:
+                self.status_message = await self._call(queued, self.channel.send(embed=embed))
+        except discord.NotFound:
+            # Deleted from under us, the next status is sent anew
+            self.status_message = None
+        except discord.HTTPException:
+            self.stats['errors'] += 1
+
+    async def _call(self, queued: float, coro):
+        started = time.monotonic()
+        self.stats['queued_seconds'] += started - queued
+        try:
+            return await coro
+        finally:
+            elapsed = time.monotonic() - started
+            self.stats['messages'] += 1
+            self.stats['send_seconds'] += elapsed
+            self.stats['send_max'] = max(self.stats['send_max'], elapsed)
 
 
 class VoiceState:
+    # How many upcoming songs get prepared, and how long before the current one ends
+    PREFETCH_COUNT = 2
+    PREFETCH_LEAD = 15
+
+    # How many playlist placeholders may be resolved at once
+    RESOLVE_CONCURRENCY = 2
+
+    # States with nothing playing or queued for this long are reaped
+    IDLE_TIMEOUT = 5 * 60
+
+    # Songs cut off further than this from their end, by their stream or
+    # the voice connection dropping, are picked back up where they stopped,
+    # at most this many times each
+    RESUME_MARGIN = 5
+    RESUME_ATTEMPTS = 3
+
     def __init__(self, bot: commands.Bot, ctx: commands.Context):
         self.bot = bot
         self._ctx = ctx
@@ -185,9 +1813,18 @@ class VoiceState:
         self.songs = SongQueue()
 
         self._loop = False
-        self._volume = 0.5
+        self._volume = YTDLSource.default_volume()
         self.skip_votes = set()
 
+        self.prefetcher = None
+        self.resolver = asyncio.Semaphore(self.RESOLVE_CONCURRENCY)
+        # Times the current song has been picked back up
+        self.resumes = 0
+
+        # Rendered queue pages, valid for one version of the queue
+        self._pages = {}
+        self._pages_version = None
+        self.last_active = time.monotonic()
         self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     def __del__(self):
@@ -209,15 +1846,101 @@ class VoiceState:
     def volume(self, value: float):
         self._volume = value
 
+        # A song still being resolved gets the volume once it has a source
+        if self.current and self.current.source:
+            self.current.source.volume = value
+
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def closed(self):
+        return self.audio_player.done()
+
+    @property
+    def idle_for(self):
+        if len(self.songs) or (self.voice and (self.voice.is_playing() or self.voice.is_paused())):
+            return 0
+        return time.monotonic() - self.last_active
+
+    def approx_size(self):
+        songs = itertools.chain([self.current] if self.current else [], self.songs)
+        return sys.getsizeof(self) + sys.getsizeof(self.skip_votes) + sum(song.approx_size() for song in songs)
+
+    def snapshot(self):
+        """Returns this player's row, and a callable building its queue rows, for SnapshotStore."""
+
+        guild_id = self._ctx.guild.id
+        current = self.current
+        position = 0.0
+        if current and current.source:
+            position = current.source.position
+        elif current:
+            position = current._offset
+
+        row = (guild_id, self.voice.channel.id, self._ctx.channel.id, self._volume, int(self._loop),
+               current.url if current else None, current.title if current else None,
+               current.requester.id if current else None, current.length if current else 0, position)
+
+        def songs():
+            return [(guild_id, i, song.url, song.title, song.requester.id, song.length)
+                    for i, song in enumerate(self.songs)]
+
+        # The queue only needs rewriting when it or the current song changed
+        return row, (self.songs.version, id(current)), songs
+
+    def queue_embed(self, page: int, items_per_page: int = 10):
+        if self._pages_version != self.songs.version:
+            self._pages.clear()
+            self._pages_version = self.songs.version
+
+        key = (page, items_per_page)
+        embed = self._pages.get(key)
+        if embed is None:
+            pages = math.ceil(len(self.songs) / items_per_page)
+            start = (page - 1) * items_per_page
+            end = start + items_per_page
+
+            queue = ''.join('`{0}.` [**{1.title}**]({1.url})\n'.format(i + 1, song)
+                            for i, song in enumerate(self.songs[start:end], start=start))
+
+            duration = YTDLSource.parse_duration(self.songs.duration)
+            embed = (discord.Embed(description='**{} tracks, {}:**\n\n{}'.format(len(self.songs), duration, queue))
+                     .set_footer(text='Viewing page {}/{}'.format(page, pages)))
+            self._pages[key] = embed
+
+        return embed
+
     async def audio_player_task(self):
+        resumed = False
         while True:
             self.next.clear()
 
-            if not self.loop:
+            if resumed:
+                pass
+            elif self.loop and self.current is not None:
+                source = self.current.source
+                if not source.frames:
+                    # A stream that doesn't play would otherwise be replayed forever
+                    self.loop = False
+                    Outbox.of(self._ctx.channel).notify(
+                        'Stopped looping **{}**, it couldn\'t be played.'.format(source.title))
+                    self.current = None
+                    continue
+
+                # The finished process can't be replayed, start a new one from
+                # the top, on a fresh stream URL if this one expired
+                source.start_offset = 0.0
+                try:
+                    await source.prepare()
+                except (YTDLError, youtube_dl.utils.DownloadError) as e:
+                    if isinstance(e, youtube_dl.utils.DownloadError):
+                        ERRORS.inc(type='download')
+                    Outbox.of(self._ctx.channel).notify('Skipping **{}**: {}'.format(source.title, e))
+                    self.current = None
+                    continue
+            else:
                 # Try to get the next song within 3 minutes.
                 # If no song will be added to the queue in time,
                 # the player will disconnect due to performance
@@ -229,17 +1952,122 @@ class VoiceState:
                     self.bot.loop.create_task(self.stop())
                     return
 
+                self.last_active = time.monotonic()
+                dequeued = time.perf_counter()
+
+                try:
+                    await self.current.resolve()
+                    # Before prepare, so a warm Opus process isn't respawned for a new volume right after
+                    self.current.source.volume = self._volume
+                    start = 'warm' if self.current.source.healthy else 'cold'
+                    await self.current.source.prepare()
+                except (YTDLError, youtube_dl.utils.DownloadError) as e:
+                    if isinstance(e, youtube_dl.utils.DownloadError):
+                        ERRORS.inc(type='download')
+                    Outbox.of(self._ctx.channel).notify('Skipping **{}**: {}'.format(self.current.title, e))
+                    # Or looping would try to replay it, with no source to spawn
+                    self.current = None
+                    continue
+
+                if self.current.requested_at is not None:
+                    self.current.source.first_frame = ('command', self.current.requested_at, start)
+                else:
+                    self.current.source.first_frame = ('queue', dequeued, start)
+
             self.current.source.volume = self._volume
             self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(embed=self.current.create_embed())
+            if not resumed:
+                self.resumes = 0
+                YTDLSource.audio_cache.record_play(self.current.source)
+                Outbox.of(self.current.source.channel).status(self.current.create_embed())
 
+            self.prefetcher = self.bot.loop.create_task(
+                self.prefetch(self.current.source.length - self.current.source.position))
             await self.next.wait()
+            self.prefetcher.cancel()
+
+            resumed = await self.recover()
+
+    async def recover(self):
+        """Seeks back to where the current song got cut off, reconnecting first if needed.
+
+        Returns whether the current song should be played again.
+        """
+
+        source = self.current.source
+        position = source.position
+        if position >= source.length - self.RESUME_MARGIN:
+            return False
+
+        # A stream that doesn't play at all would otherwise be retried
+        # from the same spot forever
+        if not source.frames or self.resumes >= self.RESUME_ATTEMPTS:
+            return False
+
+        if not self.voice.is_connected():
+            # Being kicked clears our voice state, Discord dropping the
+            # connection doesn't
+            me = self._ctx.guild.me
+            if me.voice is None or me.voice.channel is None:
+                return False
+
+            try:
+                self.voice = await me.voice.channel.connect()
+            except (discord.ClientException, asyncio.TimeoutError):
+                return False
+        elif not source.ended:
+            # Stopped on purpose, by skip or stop
+            return False
+
+        try:
+            await source.seek(position)
+        except (YTDLError, youtube_dl.utils.DownloadError):
+            return False
+
+        self.resumes += 1
+        return True
+
+    async def prefetch(self, delay: float):
+        # Playlist placeholders get resolved right away, their FFmpeg
+        # processes only get warmed up shortly before the current song ends
+        upcoming = self.songs[:self.PREFETCH_COUNT]
+        await asyncio.gather(*(self.resolve(song) for song in upcoming))
+
+        await asyncio.sleep(max(0, delay - self.PREFETCH_LEAD))
+
+        # The queue may have been cleared, shuffled or edited in the
+        # meantime, and a warmed song that isn't next just ties up FFmpeg
+        for song in self.songs[:self.PREFETCH_COUNT]:
+            if song.source is None or song not in self.songs[:self.PREFETCH_COUNT]:
+                continue
+
+            try:
+                song.source.volume = self._volume
+                await song.source.prepare(upcoming=True)
+            except (YTDLError, youtube_dl.utils.DownloadError):
+                # Tried again right before it plays
+                pass
+
+    async def resolve(self, song: Song):
+        async with self.resolver:
+            try:
+                await song.resolve()
+            except (YTDLError, youtube_dl.utils.DownloadError):
+                # Tried again right before it plays
+                pass
 
     def play_next_song(self, error=None):
+        # Called from the voice player's thread
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
         if error:
             raise VoiceError(str(error))
 
-        self.next.set()
+    def clear(self):
+        # Prefetched songs each hold an FFmpeg process
+        for song in self.songs:
+            song.cleanup()
+        self.songs.clear()
 
     def skip(self):
         self.skip_votes.clear()
@@ -248,29 +2076,279 @@ class VoiceState:
             self.voice.stop()
 
     async def stop(self):
-        self.songs.clear()
+        self.clear()
+        self.audio_player.cancel()
+
+        if self.prefetcher:
+            self.prefetcher.cancel()
+
+        if self.current:
+            if self.current.source:
+                self.current.source.cleanup()
+            self.current = None
 
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
 
 
+class SnapshotStore:
+    """SQLite snapshots of every guild's player, for resuming after a restart.
+
+    Each tick only writes the players that changed since the last one, and
+    a guild's queue rows only when its queue or current song did. Writes
+    go through a single worker thread, off the event loop.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS players (
+            guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, text_channel_id INTEGER,
+            volume REAL, loop INTEGER, url TEXT, title TEXT, requester_id INTEGER, duration INTEGER,
+            position REAL
+        );
+        CREATE TABLE IF NOT EXISTS songs (
+            guild_id INTEGER, position INTEGER, url TEXT, title TEXT, requester_id INTEGER, duration INTEGER,
+            PRIMARY KEY (guild_id, position)
+        );
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._db = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshots')
+        # guild_id -> what was last written for it
+        self._rows = {}
+        self._queues = {}
+
+    async def save(self, states):
+        rows = []
+        queues = []
+        live = set()
+
+        for state in states:
+            if not state.voice:
+                continue
+
+            row, version, songs = state.snapshot()
+            guild_id = row[0]
+            live.add(guild_id)
+
+            if self._rows.get(guild_id) != row:
+                self._rows[guild_id] = row
+                rows.append(row)
+            if self._queues.get(guild_id) != version:
+                self._queues[guild_id] = version
+                queues.append((guild_id, songs()))
+
+        # Players that left or got reaped since the last tick
+        gone = [guild_id for guild_id in self._rows if guild_id not in live]
+        for guild_id in gone:
+            del self._rows[guild_id]
+            self._queues.pop(guild_id, None)
+
+        if rows or queues or gone:
+            await self._run(self._write, rows, queues, gone)
+
+    async def load(self):
+        """Returns `(player_row, song_rows)` for every saved player."""
+
+        return await self._run(self._read)
+
+    async def forget(self, guild_id: int):
+        self._rows.pop(guild_id, None)
+        self._queues.pop(guild_id, None)
+        await self._run(self._write, [], [], [guild_id])
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    def _write(self, rows, queues, gone):
+        db = self._connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            for guild_id, songs in queues:
+                db.execute('DELETE FROM songs WHERE guild_id = ?', (guild_id,))
+                db.executemany('INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?)', songs)
+            for guild_id in gone:
+                db.execute('DELETE FROM players WHERE guild_id = ?', (guild_id,))
+                db.execute('DELETE FROM songs WHERE guild_id = ?', (guild_id,))
+
+    def _read(self):
+        db = self._connect()
+        songs = collections.defaultdict(list)
+        for row in db.execute('SELECT * FROM songs ORDER BY guild_id, position'):
+            songs[row[0]].append(row)
+        return [(row, songs[row[0]]) for row in db.execute('SELECT * FROM players')]
+
+
 class Music(commands.Cog):
+    # Where players are snapshotted to for resuming after a restart, None to turn it off
+    SNAPSHOT_PATH = 'snapshots.db'
+
+    # How long m.search results can be picked from
+    SEARCH_TTL = 5 * 60
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.voice_states = {}
+        # shard_id -> guild_id -> VoiceState
+        self.voice_states = collections.defaultdict(dict)
+        # (guild_id, user_id) -> (expires, results) of each user's last m.search
+        self.searches = {}
+        self.reaper.start()
+
+        self.snapshots = SnapshotStore(self.SNAPSHOT_PATH) if self.SNAPSHOT_PATH else None
+        self._restored = False
+        if self.snapshots:
+            self.snapshotter.start()
+
+        metrics.gauge('music_voice_states', 'Voice states, by shard.',
+                      lambda: {shard_id: len(states) for shard_id, states in self.voice_states.items()}, ('shard',))
+        metrics.gauge('music_queue_length', 'Songs queued, by guild.',
+                      lambda: {guild_id: len(state.songs) for states in self.voice_states.values()
+                               for guild_id, state in states.items()}, ('guild',))
+        metrics.gauge('ytdl_pending', 'youtube_dl lookups waiting for a pool worker.',
+                      lambda: len(YTDLSource.pool))
+        metrics.gauge('ffmpeg_warm_processes', 'FFmpeg processes pre-spawned for upcoming songs.',
+                      lambda: len(YTDLSource.ffmpeg_pool))
 
     def get_voice_state(self, ctx: commands.Context):
-        state = self.voice_states.get(ctx.guild.id)
-        if not state:
+        states = self.voice_states[ctx.guild.shard_id or 0]
+        state = states.get(ctx.guild.id)
+        # A state whose player timed out or died can't play anything anymore
+        if not state or state.closed:
+            voice = None
+            if state:
+                # Its voice connection is handed over rather than left
+                # connected with nothing able to use or close it
+                voice, state.voice = state.voice, None
+                if voice and voice.is_connected():
+                    voice.stop()
+                else:
+                    voice = None
+                self.bot.loop.create_task(state.stop())
+
             state = VoiceState(self.bot, ctx)
-            self.voice_states[ctx.guild.id] = state
+            state.voice = voice
+            states[ctx.guild.id] = state
 
         return state
 
+    def shard_stats(self, shard_id: int):
+        states = self.voice_states.get(shard_id, {}).values()
+        return {
+            'voice_states': len(states),
+            'voice_sessions': sum(1 for state in states if state.voice),
+            'queued_songs': sum(len(state.songs) for state in states),
+            'state_bytes': sum(state.approx_size() for state in states),
+        }
+
+    @tasks.loop(seconds=60)
+    async def reaper(self):
+        for states in list(self.voice_states.values()):
+            for guild_id, state in list(states.items()):
+                if state.closed or state.idle_for > VoiceState.IDLE_TIMEOUT:
+                    await state.stop()
+                    # stop() may have yielded to a command that replaced the state
+                    if states.get(guild_id) is state:
+                        del states[guild_id]
+
+        Outbox.prune()
+        YTDLSource.ffmpeg_pool.check()
+
+        now = time.monotonic()
+        for key, (expires, _) in list(self.searches.items()):
+            if expires < now:
+                del self.searches[key]
+
+    @reaper.before_loop
+    async def before_reaper(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(seconds=15)
+    async def snapshotter(self):
+        states = [state for states in self.voice_states.values() for state in states.values()]
+        await self.snapshots.save(states)
+
+    @snapshotter.before_loop
+    async def before_snapshotter(self):
+        await self.bot.wait_until_ready()
+        # Don't overwrite the snapshots before they've been restored from
+        while not self._restored:
+            await asyncio.sleep(1)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self._restored or not self.snapshots:
+            self._restored = True
+            return
+
+        try:
+            for row, songs in await self.snapshots.load():
+                guild = self.bot.get_guild(row[0])
+                # Guilds of shards running in other processes are theirs to restore
+                if guild is None:
+                    continue
+
+                try:
+                    await self.restore(guild, row, songs)
+                except (discord.DiscordException, asyncio.TimeoutError):
+                    await self.snapshots.forget(guild.id)
+        finally:
+            self._restored = True
+
+    async def restore(self, guild: discord.Guild, row: tuple, songs: list):
+        _, voice_channel_id, text_channel_id, volume, loop, url, title, requester_id, duration, position = row
+
+        voice_channel = guild.get_channel(voice_channel_id)
+        text_channel = guild.get_channel(text_channel_id)
+        if voice_channel is None or text_channel is None:
+            await self.snapshots.forget(guild.id)
+            return
+
+        # One stand-in context per requester, songs are only resolved once they near the head of the queue
+        contexts = {}
+
+        async def context_for(member_id):
+            if member_id not in contexts:
+                member = guild.get_member(member_id)
+                if member is None:
+                    try:
+                        member = await guild.fetch_member(member_id)
+                    except discord.HTTPException:
+                        member = guild.me
+                contexts[member_id] = StandInContext(guild, text_channel, member)
+            return contexts[member_id]
+
+        state = VoiceState(self.bot, StandInContext(guild, text_channel, guild.me))
+        self.voice_states[guild.shard_id or 0][guild.id] = state
+        state.voice = await voice_channel.connect()
+        state.volume = volume
+
+        if url:
+            entry = {'webpage_url': url, 'title': title, 'duration': duration}
+            state.songs.put_nowait(Song.placeholder(await context_for(requester_id), entry, offset=position))
+        for _, _, url, title, requester_id, duration in songs:
+            entry = {'webpage_url': url, 'title': title, 'duration': duration}
+            state.songs.put_nowait(Song.placeholder(await context_for(requester_id), entry))
+
+        state.loop = bool(loop)
+
     def cog_unload(self):
-        for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+        self.reaper.cancel()
+        if self.snapshots:
+            self.snapshotter.cancel()
+
+        for states in self.voice_states.values():
+            for state in states.values():
+                self.bot.loop.create_task(state.stop())
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -279,10 +2357,12 @@ class Music(commands.Cog):
         return True
 
     async def cog_before_invoke(self, ctx: commands.Context):
+        ctx.invoked_at = time.perf_counter()
         ctx.voice_state = self.get_voice_state(ctx)
+        ctx.outbox = Outbox.of(ctx.channel)
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
-        await ctx.send('An error occurred: {}'.format(str(error)))
+        Outbox.of(ctx.channel).notify('An error occurred: {}'.format(str(error)))
 
     @commands.command(name='join', invoke_without_subcommand=True)
     async def _join(self, ctx: commands.Context):
@@ -316,29 +2396,34 @@ class Music(commands.Cog):
         """Clears the queue and leaves the voice channel."""
 
         if not ctx.voice_state.voice:
-            return await ctx.send('Not connected to any voice channel.')
+            return await ctx.outbox.send('Not connected to any voice channel.')
 
         await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        del self.voice_states[ctx.guild.shard_id or 0][ctx.guild.id]
 
     @commands.command(name='volume')
     async def _volume(self, ctx: commands.Context, *, volume: int):
-        """Sets the volume of the player."""
+        """Sets the volume of the player.
+        Opus streams are only played without re-encoding at exactly 100%.
+        """
 
         if not ctx.voice_state.is_playing:
-            return await ctx.send('Nothing being played at the moment.')
+            return await ctx.outbox.send('Nothing being played at the moment.')
 
-        if 0 > volume > 100:
-            return await ctx.send('Volume must be between 0 and 100')
+        if not 0 <= volume <= 100:
+            return await ctx.outbox.send('Volume must be between 0 and 100')
 
         ctx.voice_state.volume = volume / 100
-        await ctx.send('Volume of the player set to {}%'.format(volume))
+        await ctx.outbox.send('Volume of the player set to {}%'.format(volume))
 
     @commands.command(name='now', aliases=['current', 'playing'])
     async def _now(self, ctx: commands.Context):
         """Displays the currently playing song."""
 
-        await ctx.send(embed=ctx.voice_state.current.create_embed())
+        if not ctx.voice_state.is_playing or ctx.voice_state.current.source is None:
+            return await ctx.outbox.send('Nothing being played at the moment.')
+
+        await ctx.outbox.send(embed=ctx.voice_state.current.create_embed())
 
     @commands.command(name='pause')
     async def _pause(self, ctx: commands.Context):
@@ -353,11 +2438,37 @@ class Music(commands.Cog):
         ctx.voice_client.resume()
         await ctx.message.add_reaction('⏯')
 
+    @commands.command(name='seek')
+    async def _seek(self, ctx: commands.Context, *, position: str):
+        """Seeks to a position in the current song.
+        Takes a timestamp like `1:30`, or `+15`/`-15` to seek relative to where it's at.
+        """
+
+        if not ctx.voice_state.is_playing or ctx.voice_state.current.source is None:
+            return await ctx.outbox.send('Nothing being played at the moment.')
+
+        source = ctx.voice_state.current.source
+        try:
+            offset = YTDLSource.parse_timestamp(position)
+        except ValueError:
+            return await ctx.outbox.send('Invalid position `{}`, use a timestamp like `1:30`.'.format(position))
+
+        if position.startswith(('+', '-')):
+            offset = max(source.position + offset, 0.0)
+        if offset >= source.length:
+            return await ctx.outbox.send('The song is only {} long.'.format(source.duration))
+
+        try:
+            await source.seek(offset)
+        except (YTDLError, youtube_dl.utils.DownloadError) as e:
+            return await ctx.outbox.send('Couldn\'t seek: {}'.format(e))
+        await ctx.message.add_reaction('⏩')
+
     @commands.command(name='stop')
     async def _stop(self, ctx: commands.Context):
         """Stops playing song and clears the queue."""
 
-        await ctx.voice_state.songs.clear()
+        ctx.voice_state.clear()
 
         if ctx.voice_state.is_playing:
             ctx.voice_state.voice.stop()
@@ -370,7 +2481,7 @@ class Music(commands.Cog):
         """
 
         if not ctx.voice_state.is_playing:
-            return await ctx.send('Not playing any music right now...')
+            return await ctx.outbox.send('Not playing any music right now...')
 
         voter = ctx.message.author
         if voter == ctx.voice_state.current.requester:
@@ -385,10 +2496,10 @@ class Music(commands.Cog):
                 await ctx.message.add_reaction('⏭')
                 ctx.voice_state.skip()
             else:
-                await ctx.send('Skip vote added, currently at **{}/3**'.format(total_votes))
+                await ctx.outbox.send('Skip vote added, currently at **{}/3**'.format(total_votes))
 
         else:
-            await ctx.send('You have already voted to skip this song.')
+            await ctx.outbox.send('You have already voted to skip this song.')
 
     @commands.command(name='queue')
     async def _queue(self, ctx: commands.Context, *, page: int = 1):
@@ -397,30 +2508,18 @@ class Music(commands.Cog):
         """
 
         if len(ctx.voice_state.songs) == 0:
-            return await ctx.send('Empty queue.')
-
-        items_per_page = 10
-        pages = math.ceil(len(ctx.voice_state.songs) / items_per_page)
-
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
-
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(i + 1, song)
+            return await ctx.outbox.send('Empty queue.')
 
-        embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
-                 .set_footer(text='Viewing page {}/{}'.format(page, pages)))
-        await ctx.send(embed=embed)
+        await ctx.outbox.send(embed=ctx.voice_state.queue_embed(page))
 
     @commands.command(name='shuffle')
     async def _shuffle(self, ctx: commands.Context):
         """Shuffles the queue."""
 
         if len(ctx.voice_state.songs) == 0:
-            return await ctx.send('Empty queue.')
+            return await ctx.outbox.send('Empty queue.')
 
-        await ctx.voice_state.songs.shuffle()
+        ctx.voice_state.songs.shuffle()
         await ctx.message.add_reaction('✅')
 
     @commands.command(name='remove')
@@ -428,9 +2527,19 @@ class Music(commands.Cog):
         """Removes a song from the queue at a given index."""
 
         if len(ctx.voice_state.songs) == 0:
-            return await ctx.send('Empty queue.')
+            return await ctx.outbox.send('Empty queue.')
+
+        ctx.voice_state.songs.remove(index - 1).cleanup()
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(name='move')
+    async def _move(self, ctx: commands.Context, index: int, destination: int):
+        """Moves a song in the queue from one index to another."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.outbox.send('Empty queue.')
 
-        ctx.voice_state.songs.remove(index - 1)
+        ctx.voice_state.songs.move(index - 1, destination - 1)
         await ctx.message.add_reaction('✅')
 
     @commands.command(name='loop')
@@ -440,7 +2549,7 @@ class Music(commands.Cog):
         """
 
         if not ctx.voice_state.is_playing:
-            return await ctx.send('Nothing being played at the moment.')
+            return await ctx.outbox.send('Nothing being played at the moment.')
 
         # Inverse boolean value to loop and unloop.
         ctx.voice_state.loop = not ctx.voice_state.loop
@@ -460,17 +2569,97 @@ class Music(commands.Cog):
 
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
+                source = await YTDLSource.create_source(ctx, search)
             except YTDLError as e:
-                await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+                await ctx.outbox.send('An error occurred while processing this request: {}'.format(str(e)))
+            else:
+                await self.enqueue(ctx, source)
+
+    async def enqueue(self, ctx: commands.Context, source: YTDLSource):
+        song = Song(source)
+        if ctx.voice_state.songs.empty() and not ctx.voice_state.voice.is_playing():
+            song.requested_at = ctx.invoked_at
+
+        await ctx.voice_state.songs.put(song)
+        ctx.outbox.notify('Enqueued {}'.format(str(source)))
+
+    @commands.command(name='search')
+    async def _search(self, ctx: commands.Context, *, search: str):
+        """Searches YouTube for songs to choose from.
+        Play one of the results with `pick`, they're kept for a few minutes.
+        """
+
+        async with ctx.typing():
+            try:
+                results = await YTDLSource.search_results(ctx, search)
+            except (YTDLError, youtube_dl.utils.DownloadError) as e:
+                return await ctx.outbox.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        self.searches[ctx.guild.id, ctx.author.id] = (time.monotonic() + self.SEARCH_TTL, results)
+
+        lines = []
+        for i, result in enumerate(results, start=1):
+            duration = '{}:{:02d}'.format(*divmod(int(result['duration']), 60)) if result['duration'] else '?'
+            lines.append('`{}.` [**{}**]({}) `{}`{}'.format(
+                i, result['title'] or result['webpage_url'], result['webpage_url'], duration,
+                ' by {}'.format(result['uploader']) if result['uploader'] else ''))
+
+        embed = (discord.Embed(title='Results for {}'.format(search), description='\n'.join(lines))
+                 .set_footer(text='Play one with m.pick <number>'))
+        await ctx.outbox.send(embed=embed)
+
+    @commands.command(name='pick')
+    async def _pick(self, ctx: commands.Context, number: int):
+        """Plays one of the results of your last search."""
+
+        expires, results = self.searches.get((ctx.guild.id, ctx.author.id), (0, None))
+        if expires < time.monotonic():
+            return await ctx.outbox.send('Search for something first with `m.search`.')
+
+        if not 1 <= number <= len(results):
+            return await ctx.outbox.send('Pick a number between 1 and {}.'.format(len(results)))
+
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+
+        webpage_url = results[number - 1]['webpage_url']
+        async with ctx.typing():
+            try:
+                source = await YTDLSource.from_url(ctx, webpage_url)
+            except (YTDLError, youtube_dl.utils.DownloadError) as e:
+                await ctx.outbox.send('An error occurred while processing this request: {}'.format(str(e)))
             else:
-                song = Song(source)
+                await self.enqueue(ctx, source)
+
+    @commands.command(name='playlist')
+    async def _playlist(self, ctx: commands.Context, *, url: str):
+        """Queues every song of a playlist.
+        Songs are added right away and only looked up once they're about to play.
+        """
+
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
 
-                await ctx.voice_state.songs.put(song)
-                await ctx.send('Enqueued {}'.format(str(source)))
+        message = await ctx.outbox.send('Reading the playlist...')
+        # Shared by all of the playlist's songs
+        requested = StandInContext.of(ctx)
+        total = 0
+        try:
+            async for title, entries in YTDLSource.iter_playlist(ctx, url):
+                for entry in entries:
+                    await ctx.voice_state.songs.put(Song.placeholder(requested, entry))
+                total += len(entries)
+
+                await message.edit(content='Enqueued {} songs from **{}** so far...'.format(total, title))
+        except (YTDLError, youtube_dl.utils.DownloadError) as e:
+            await message.edit(content='An error occurred while processing this request: {}'.format(str(e)))
+        else:
+            await message.edit(content='Enqueued {} songs from **{}**'.format(total, title))
 
     @_join.before_invoke
     @_play.before_invoke
+    @_pick.before_invoke
+    @_playlist.before_invoke
     async def ensure_voice_state(self, ctx: commands.Context):
         if not ctx.author.voice or not ctx.author.voice.channel:
             raise commands.CommandError('You are not connected to any voice channel.')
@@ -482,10 +2671,148 @@ class Music(commands.Cog):
 
 import re
 
+
+class MoveParseError(ValueError):
+    """Raised when a move can't be read, `code` says why: "empty", "invalid", "conflict" or "ambiguous"."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class MoveParser:
+    """Reads a move in one pass over the text.
+
+    Every notation is a token in a precomputed table: position words (top,
+    bottom, left, right, middle/center), cell numbers counted row by row
+    from 1, algebraic cells (column letter, row number, so a1 is top-left)
+    and, on 3x3 boards, keycap and arrow emoji. Position words are bit
+    flags, and each combination of flags maps to a cell in a second table.
+    Anything shaped like a cell number that isn't in the table is rejected.
+    """
+
+    TOP, BOTTOM, LEFT, RIGHT, MIDDLE = 1, 2, 4, 8, 16
+    WORDS = {"top": TOP, "bottom": BOTTOM, "left": LEFT, "right": RIGHT,
+             "middle": MIDDLE, "center": MIDDLE, "centre": MIDDLE}
+    ARROWS = "↖⬆↗⬅⏺➡↙⬇↘"
+    CELL = re.compile("[a-z]?[0-9]+")
+
+    def __init__(self, size=3):
+        self.size = size
+
+        # token -> word flag, or the (x, y) cell it names
+        self.tokens = dict(self.WORDS)
+        for cell in range(size * size):
+            x, y = divmod(cell, size)
+            self.tokens[str(cell + 1)] = (x, y)
+            self.tokens["{}{}".format(chr(ord("a") + y), x + 1)] = (x, y)
+            if size == 3:
+                self.tokens["{}\u20e3".format(cell + 1)] = (x, y)
+                self.tokens[self.ARROWS[cell]] = (x, y)
+
+        # Numbers and algebraic cells are read whole, with or without a
+        # letter in front, so "10", "a10" or "d1" don't match part of
+        # themselves and get looked up, and turned down, as they are
+        others = sorted((token for token in self.tokens if not self.CELL.fullmatch(token)), key=len, reverse=True)
+        self.pattern = re.compile("|".join([re.escape(token) for token in others] + [self.CELL.pattern]))
+
+        # Word flags -> cell, or None when the words contradict each other
+        middle = size // 2
+        self.words = {}
+        for flags in range(1, 32):
+            if flags & self.TOP and flags & self.BOTTOM or flags & self.LEFT and flags & self.RIGHT:
+                self.words[flags] = None
+                continue
+
+            # Top/bottom alone means the middle of that row, left/right alone
+            # the middle of that column, and middle alone the very middle
+            x = 0 if flags & self.TOP else size - 1 if flags & self.BOTTOM else middle
+            y = 0 if flags & self.LEFT else size - 1 if flags & self.RIGHT else middle
+            self.words[flags] = (x, y)
+
+    def parse(self, text):
+        flags = 0
+        cell = None
+        cells = 0
+        # Emoji may come with a variation selector, which isn't part of any token
+        for token in self.pattern.findall(text.lower().replace("\ufe0f", "")):
+            value = self.tokens.get(token)
+            if value is None:
+                raise MoveParseError("invalid", "There is no {} on this board!".format(token))
+            if isinstance(value, int):
+                flags |= value
+            else:
+                cell = value
+                cells += 1
+
+        if cells:
+            if cells > 1 or flags:
+                raise MoveParseError("ambiguous", "Give me just one location to play!")
+            return cell
+
+        # Make sure at least something was given
+        if not flags:
+            raise MoveParseError("empty", "Please provide a valid location to play!")
+
+        cell = self.words[flags]
+        # Just a bit of logic to ensure nothing that doesn't make sense is given
+        if cell is None:
+            raise MoveParseError("conflict", "That is not a valid location! Use some logic, come on!")
+        return cell
+
+
+@functools.lru_cache(maxsize=None)
+def get_move_parser(size=3):
+    return MoveParser(size)
+
+
+def parse_move(text, size=3):
+    return get_move_parser(size).parse(text)
+
+
+@functools.lru_cache(maxsize=None)
+def win_masks(size: int, k: int):
+    # Every run of k cells in a row, column or diagonal, as a bitmask over the
+    # size x size cells numbered row by row. A player has won once their bits
+    # cover one of these completely.
+    masks = []
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_row = row + d_row * (k - 1)
+                end_col = col + d_col * (k - 1)
+                if not (0 <= end_row < size and 0 <= end_col < size):
+                    continue
+
+                mask = 0
+                for i in range(k):
+                    mask |= 1 << ((row + d_row * i) * size + col + d_col * i)
+                masks.append(mask)
+    return tuple(masks)
+
+
+@functools.lru_cache(maxsize=8192)
+def render_board(size: int, x_bits: int, o_bits: int):
+    # Simple formatting here when you look at it, enough spaces to even out where everything is
+    # Place whatever is at the grid in place, whether it's x, o, or blank
+    rows = []
+    for row in range(size):
+        cells = []
+        for col in range(size):
+            bit = 1 << (row * size + col)
+            cells.append("x" if x_bits & bit else "o" if o_bits & bit else " ")
+        rows.append(" " + "  |  ".join(cells) + "\n")
+    return "```\n{}```".format(("—" * 5 * size + "\n").join(rows))
+
+
 class Board:
-    def __init__(self, player1, player2):
-        # Our board just needs to be a 3x3 grid. To keep formatting nice, each one is going to be a space to start
-        self.board = [[" ", " ", " "], [" ", " ", " "], [" ", " ", " "]]
+    def __init__(self, player1, player2, size=3, k=3):
+        # Each player's pieces are a bitmask of the cells they hold, cell (x, y) being bit x * size + y
+        self.size = size
+        self.k = k
+        self.pieces = {"x": 0, "o": 0}
+        self.masks = win_masks(size, k)
+        self.full_mask = (1 << size * size) - 1
 
         # Randomize who goes first when the board is created
         if random.SystemRandom().randint(0, 1):
@@ -496,12 +2823,22 @@ class Board:
         # X's always go first
         self.X_turn = True
 
+    @property
+    def board(self):
+        # The grid as rows of "x", "o" and " ", the way it used to be stored
+        return [
+            [
+                "x" if self.pieces["x"] >> (row * self.size + col) & 1
+                else "o" if self.pieces["o"] >> (row * self.size + col) & 1
+                else " "
+                for col in range(self.size)
+            ]
+            for row in range(self.size)
+        ]
+
     def full(self):
-        # For this check we just need to see if there is a space anywhere, if there is then we're not full
-        for row in self.board:
-            if " " in row:
-                return False
-        return True
+        # Full once every cell is held by one of the players
+        return self.pieces["x"] | self.pieces["o"] == self.full_mask
 
     def can_play(self, player):
         # Simple check to see if the player is the one that's up
@@ -514,127 +2851,347 @@ class Board:
         # If it's x's turn, we place an x, otherwise place an o
         letter = "x" if self.X_turn else "o"
         # Make sure the place we're trying to update is blank, we can't override something
-        if self.board[x][y] == " ":
-            self.board[x][y] = letter
-        else:
+        bit = 1 << (x * self.size + y)
+        if (self.pieces["x"] | self.pieces["o"]) & bit:
             return False
+        self.pieces[letter] |= bit
         # If we were succesful in placing the piece, we need to switch whose turn it is
         self.X_turn = not self.X_turn
         return True
 
     def check(self):
-        # Checking all possiblities will be fun...
-        # First base off the top-left corner, see if any possiblities with that match
-        # We need to also make sure that the place is not blank, so that 3 in a row that are blank doesn't cause a 'win'
-        # Top-left, top-middle, top right
-        if (
-            self.board[0][0] == self.board[0][1]
-            and self.board[0][0] == self.board[0][2]
-            and self.board[0][0] != " "
-        ):
-            return self.challengers[self.board[0][0]]
-        # Top-left, middle-left, bottom-left
-        if (
-            self.board[0][0] == self.board[1][0]
-            and self.board[0][0] == self.board[2][0]
-            and self.board[0][0] != " "
-        ):
-            return self.challengers[self.board[0][0]]
-        # Top-left, middle, bottom-right
-        if (
-            self.board[0][0] == self.board[1][1]
-            and self.board[0][0] == self.board[2][2]
-            and self.board[0][0] != " "
-        ):
-            return self.challengers[self.board[0][0]]
-
-        # Next check the top-right corner, not re-checking the last possiblity that included it
-        # Top-right, middle-right, bottom-right
-        if (
-            self.board[0][2] == self.board[1][2]
-            and self.board[0][2] == self.board[2][2]
-            and self.board[0][2] != " "
-        ):
-            return self.challengers[self.board[0][2]]
-        # Top-right, middle, bottom-left
-        if (
-            self.board[0][2] == self.board[1][1]
-            and self.board[0][2] == self.board[2][0]
-            and self.board[0][2] != " "
-        ):
-            return self.challengers[self.board[0][2]]
-
-        # Next up, bottom-right corner, only one possiblity to check here, other two have been checked
-        # Bottom-right, bottom-middle, bottom-left
-        if (
-            self.board[2][2] == self.board[2][1]
-            and self.board[2][2] == self.board[2][0]
-            and self.board[2][2] != " "
-        ):
-            return self.challengers[self.board[2][2]]
-
-        # No need to check the bottom-left, all posiblities have been checked now
-        # Base things off the middle now, as we only need the two 'middle' possiblites that aren't diagonal
-        # Top-middle, middle, bottom-middle
-        if (
-            self.board[1][1] == self.board[0][1]
-            and self.board[1][1] == self.board[2][1]
-            and self.board[1][1] != " "
-        ):
-            return self.challengers[self.board[1][1]]
-        # Left-middle, middle, right-middle
-        if (
-            self.board[1][1] == self.board[1][0]
-            and self.board[1][1] == self.board[1][2]
-            and self.board[1][1] != " "
-        ):
-            return self.challengers[self.board[1][1]]
+        # A player has won if all the bits of any winning line are theirs
+        for letter, bits in self.pieces.items():
+            for mask in self.masks:
+                if bits & mask == mask:
+                    return self.challengers[letter]
 
         # Otherwise nothing has been found, return None
         return None
 
     def __str__(self):
-        # Simple formatting here when you look at it, enough spaces to even out where everything is
-        # Place whatever is at the grid in place, whether it's x, o, or blank
-        _board = " {}  |  {}  |  {}\n".format(
-            self.board[0][0], self.board[0][1], self.board[0][2]
-        )
-        _board += "———————————————\n"
-        _board += " {}  |  {}  |  {}\n".format(
-            self.board[1][0], self.board[1][1], self.board[1][2]
+        # Rendered boards are cached per position, so reprinting one is a lookup
+        return render_board(self.size, self.pieces["x"], self.pieces["o"])
+
+
+@functools.lru_cache(maxsize=None)
+def board_symmetries(size: int):
+    # The 8 rotations and reflections of a square board, each given as the
+    # cell that every cell is moved to
+    symmetries = []
+    for flip in (False, True):
+        for turns in range(4):
+            mapping = []
+            for row in range(size):
+                for col in range(size):
+                    r, c = row, (size - 1 - col if flip else col)
+                    for _ in range(turns):
+                        r, c = c, size - 1 - r
+                    mapping.append(r * size + c)
+            symmetries.append(tuple(mapping))
+    return tuple(dict.fromkeys(symmetries))
+
+
+class Solver:
+    """Perfect-play TicTacToe opponent.
+
+    Negamax with alpha-beta pruning, backed by a transposition table keyed
+    by each position's canonical form under the board's symmetries. On 3x3
+    the whole game fits in the table and every move is looked up from the
+    `best` cache. Bigger boards are searched with iterative deepening,
+    limited by `depth` and `budget` seconds, using a line-counting
+    heuristic below that depth.
+    """
+
+    WIN = 1000
+    EXACT, LOWER, UPPER = range(3)
+
+    def __init__(self, size=3, k=3, *, depth=None, budget=None):
+        self.size = size
+        self.cells = size * size
+        self.masks = win_masks(size, k)
+        self.full_mask = (1 << self.cells) - 1
+        self.depth = depth
+        self.budget = budget
+
+        # Each symmetry as byte lookup tables, so mapping a bitboard costs one
+        # lookup per 8 cells instead of one step per cell
+        self._symmetries = []
+        for mapping in board_symmetries(size):
+            tables = []
+            for offset in range(0, self.cells, 8):
+                table = []
+                for byte in range(256):
+                    bits = 0
+                    for i in range(8):
+                        if byte >> i & 1 and offset + i < self.cells:
+                            bits |= 1 << mapping[offset + i]
+                    table.append(bits)
+                tables.append(table)
+            self._symmetries.append(tables)
+
+        # Cells crossed by the most winning lines are searched first
+        weights = [sum(1 for mask in self.masks if mask >> cell & 1) for cell in range(self.cells)]
+        self._order = sorted(range(self.cells), key=lambda cell: -weights[cell])
+
+        # canonical (me, opp) -> (depth, flag, score)
+        self.table = {}
+        # (me, opp) -> best cell, for positions searched to the end
+        self.best = {}
+        self._deadline = None
+
+    def canonical(self, me, opp):
+        return min(
+            (self._transform(tables, me), self._transform(tables, opp))
+            for tables in self._symmetries
         )
-        _board += "———————————————\n"
-        _board += " {}  |  {}  |  {}\n".format(
-            self.board[2][0], self.board[2][1], self.board[2][2]
-        )
-        return "```\n{}```".format(_board)
+
+    @staticmethod
+    def _transform(tables, bits):
+        result = 0
+        for table in tables:
+            result |= table[bits & 0xff]
+            bits >>= 8
+        return result
+
+    def won(self, bits):
+        for mask in self.masks:
+            if bits & mask == mask:
+                return True
+        return False
+
+    def best_move(self, board):
+        """Returns the (x, y) cell to play for whoever's turn it is on `board`."""
+
+        me, opp = (board.pieces["x"], board.pieces["o"]) if board.X_turn else (board.pieces["o"], board.pieces["x"])
+        return divmod(self.best_move_bits(me, opp), self.size)
+
+    def warm(self):
+        # Solves every position reachable from the empty board
+        stack = [(0, 0)]
+        seen = set()
+        while stack:
+            me, opp = stack.pop()
+            if (me, opp) in seen or self.won(opp) or me | opp == self.full_mask:
+                continue
+            seen.add((me, opp))
+            self.best_move_bits(me, opp)
+
+            for cell in range(self.cells):
+                bit = 1 << cell
+                if not (me | opp) & bit:
+                    stack.append((opp, me | bit))
+
+    def best_move_bits(self, me, opp):
+        cell = self.best.get((me, opp))
+        if cell is None:
+            cell = self._choose(me, opp)
+        return cell
+
+    def _choose(self, me, opp):
+        empties = self.cells - bin(me | opp).count("1")
+        max_depth = empties if self.depth is None else min(self.depth, empties)
+        self._deadline = None if self.budget is None else time.perf_counter() + self.budget
+
+        best = None
+        completed = 0
+        for depth in range(1 if self.budget else max_depth, max_depth + 1):
+            try:
+                best = self._root(me, opp, depth)
+            except TimeoutError:
+                break
+            completed = depth
+
+        # Only a search that reached the end of the game is worth remembering
+        if completed == empties:
+            self.best[(me, opp)] = best
+        if best is None:
+            # Out of time before even one ply, any free cell will do
+            best = next(cell for cell in self._order if not (me | opp) >> cell & 1)
+        return best
+
+    def _root(self, me, opp, depth):
+        best_score = -math.inf
+        best_cells = []
+        for cell in self._order:
+            bit = 1 << cell
+            if (me | opp) & bit:
+                continue
+
+            score = -self._search(opp, me | bit, depth - 1, -math.inf, -best_score + 1)
+            if score > best_score:
+                best_score, best_cells = score, [cell]
+            elif score == best_score:
+                best_cells.append(cell)
+        return random.choice(best_cells)
+
+    def _search(self, me, opp, depth, alpha, beta):
+        # `opp` just moved, so only they can have completed a line
+        empty = self.full_mask & ~(me | opp)
+        if self.won(opp):
+            # Losing later is better than losing now
+            return -(self.WIN + bin(empty).count("1"))
+        if not empty:
+            return 0
+        if depth == 0:
+            return self._evaluate(me, opp)
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            raise TimeoutError
+
+        key = self.canonical(me, opp)
+        entry = self.table.get(key)
+        if entry is not None and entry[0] >= depth:
+            _, flag, score = entry
+            if flag == self.EXACT:
+                return score
+            if flag == self.LOWER:
+                alpha = max(alpha, score)
+            else:
+                beta = min(beta, score)
+            if alpha >= beta:
+                return score
+
+        original_alpha = alpha
+        best = -math.inf
+        for cell in self._order:
+            bit = 1 << cell
+            if not empty & bit:
+                continue
+
+            score = -self._search(opp, me | bit, depth - 1, -beta, -alpha)
+            if score > best:
+                best = score
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+
+        if best <= original_alpha:
+            flag = self.UPPER
+        elif best >= beta:
+            flag = self.LOWER
+        else:
+            flag = self.EXACT
+        self.table[key] = (depth, flag, best)
+        return best
+
+    def _evaluate(self, me, opp):
+        # Lines still open to one side only, weighted by how filled in they are
+        score = 0
+        for mask in self.masks:
+            if not opp & mask:
+                score += bin(me & mask).count("1") ** 2
+            elif not me & mask:
+                score -= bin(opp & mask).count("1") ** 2
+        return max(-self.WIN + 1, min(self.WIN - 1, score))
+
+
+@functools.lru_cache(maxsize=None)
+def get_solver(size=3, k=3):
+    # 3x3 is solved exactly, anything bigger gets a small time budget
+    if size == 3:
+        return Solver(size, k)
+    return Solver(size, k, budget=0.05)
+
+
+class GameStore:
+    """Live TicTacToe games, keyed by channel and pair of players.
+
+    A player can only be in one game per channel, so the board a move
+    belongs to is found in O(1) through `players`. Games are kept least
+    recently played first, which makes expiring the idle ones a matter of
+    popping from the front until one is still fresh.
+    """
+
+    def __init__(self, ttl=15 * 60, max_games=500):
+        self.ttl = ttl
+        self.max_games = max_games
+
+        # (channel_id, frozenset of player ids) -> Board
+        self.games = collections.OrderedDict()
+        # (channel_id, player_id) -> game key
+        self.players = {}
+
+    def __len__(self):
+        self.expire()
+        return len(self.games)
+
+    def add(self, channel_id, board, bot_user=None):
+        # Returns False if there's no room for another game
+        self.expire()
+        if len(self.games) >= self.max_games:
+            return False
+
+        players = [player for player in board.challengers.values() if player != bot_user]
+        board.key = (channel_id, frozenset(player.id for player in board.challengers.values()))
+        board.last_move = time.monotonic()
+
+        self.games[board.key] = board
+        for player in players:
+            self.players[(channel_id, player.id)] = board.key
+        return True
+
+    def find(self, channel_id, player):
+        self.expire()
+        key = self.players.get((channel_id, player.id))
+        if key is None:
+            return None
+
+        board = self.games[key]
+        board.last_move = time.monotonic()
+        self.games.move_to_end(key)
+        return board
+
+    def remove(self, board):
+        if self.games.pop(board.key, None) is None:
+            return
+
+        channel_id, _ = board.key
+        for player in board.challengers.values():
+            if self.players.get((channel_id, player.id)) == board.key:
+                del self.players[(channel_id, player.id)]
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self.games:
+            board = next(iter(self.games.values()))
+            if board.last_move > deadline:
+                break
+            self.remove(board)
 
 
 class TicTacToe(commands.Cog):
     """Pretty self-explanatory"""
 
-    boards = {}
+    # Games are kept per shard, then by channel and players
+    games = collections.defaultdict(GameStore)
+
+    def get_games(self, guild):
+        return self.games[guild.shard_id or 0]
 
-    def create(self, server_id, player1, player2):
-        self.boards[server_id] = Board(player1, player2)
+    def create(self, ctx, player1, player2):
+        board = Board(player1, player2)
+        if not self.get_games(ctx.guild).add(ctx.channel.id, board, ctx.guild.me):
+            return None
 
-        # Return whoever is x's so that we know who is going first
-        return self.boards[server_id].challengers["x"]
+        # Return the board, its challengers tell us who is going first
+        return board
 
     @commands.group(aliases=["tic", "tac", "toe"], invoke_without_command=True)
     @commands.guild_only()
     async def tictactoe(self, ctx, *, option: str):
-        """Updates the current server's tic-tac-toe board
-        You obviously need to be one of the players to use this
+        """Updates your tic-tac-toe board in this channel
+        You obviously need to be playing a game here to use this
         It also needs to be your turn
         Provide top, left, bottom, right, middle as you want to mark where to play on the board
+        You can also give the cell as a number from 1 to 9, a letter and number like b2, or an emoji like 5️⃣
         EXAMPLE: !tictactoe middle top
         RESULT: Your piece is placed in the very top space, in the middle"""
         player = ctx.message.author
-        board = self.boards.get(ctx.message.guild.id)
+        board = self.get_games(ctx.message.guild).find(ctx.channel.id, player)
         # Need to make sure the board exists before allowing someone to play
         if not board:
-            await ctx.send("There are currently no Tic-Tac-Toe games setup!")
+            await ctx.send("You aren't playing Tic-Tac-Toe in this channel!")
             return
         # Now just make sure the person can play, this will fail if o's are up and x tries to play
         # Or if someone else entirely tries to play
@@ -642,48 +3199,11 @@ class TicTacToe(commands.Cog):
             await ctx.send("You cannot play right now!")
             return
 
-        # Search for the positions in the option given, the actual match doesn't matter, just need to check if it exists
-        top = re.search("top", option)
-        middle = re.search("middle", option)
-        bottom = re.search("bottom", option)
-        left = re.search("left", option)
-        right = re.search("right", option)
-
-        # Just a bit of logic to ensure nothing that doesn't make sense is given
-        if top and bottom:
-            await ctx.send("That is not a valid location! Use some logic, come on!")
+        try:
+            x, y = parse_move(option, board.size)
+        except MoveParseError as e:
+            await ctx.send(str(e))
             return
-        if left and right:
-            await ctx.send("That is not a valid location! Use some logic, come on!")
-            return
-        # Make sure at least something was given
-        if not top and not bottom and not left and not right and not middle:
-            await ctx.send("Please provide a valid location to play!")
-            return
-
-        x = 0
-        y = 0
-        # Simple assignments
-        if top:
-            x = 0
-        if bottom:
-            x = 2
-        if left:
-            y = 0
-        if right:
-            y = 2
-        # If middle was given and nothing else, we need the exact middle
-        if middle and not (top or bottom or left or right):
-            x = 1
-            y = 1
-        # If just top or bottom was given, we assume this means top-middle or bottom-middle
-        # We don't need to do anything fancy with top/bottom as it's already assigned, just assign middle
-        if (top or bottom) and not (left or right):
-            y = 1
-        # If just left or right was given, we assume this means left-middle or right-middle
-        # We don't need to do anything fancy with left/right as it's already assigned, just assign middle
-        elif (left or right) and not (top or bottom):
-            x = 1
 
         # If all checks have been made, x and y should now be defined
         # Correctly based on the matches, and we can go ahead and update the board
@@ -693,6 +3213,11 @@ class TicTacToe(commands.Cog):
         if not board.update(x, y):
             await ctx.send("Someone has already played there!")
             return
+        await self.end_turn(ctx, board)
+
+    async def end_turn(self, ctx, board, bot_moved=False):
+        # If the bot played the last move, show the board so everyone can see where
+        prefix = str(board) + "\n" if bot_moved else ""
         # Next check if there's a winner
         winner = board.check()
         if winner:
@@ -704,24 +3229,18 @@ class TicTacToe(commands.Cog):
                 else board.challengers["o"]
             )
             await ctx.send(
-                "{} has won this game of TicTacToe, better luck next time {}".format(
+                prefix + "{} has won this game of TicTacToe, better luck next time {}".format(
                     winner.display_name, loser.display_name
                 )
             )
             # Handle updating ratings based on the winner and loser
             # This game has ended, delete it so another one can be made
-            try:
-                del self.boards[ctx.message.guild.id]
-            except KeyError:
-                pass
+            self.get_games(ctx.message.guild).remove(board)
         else:
             # If no one has won, make sure the game is not full. If it has, delete the board and say it was a tie
             if board.full():
-                await ctx.send("This game has ended in a tie!")
-                try:
-                    del self.boards[ctx.message.guild.id]
-                except KeyError:
-                    pass
+                await ctx.send(prefix + "This game has ended in a tie!")
+                self.get_games(ctx.message.guild).remove(board)
             # If no one has won, and the game has not ended in a tie, print the new updated board
             else:
                 player_turn = (
@@ -729,6 +3248,11 @@ class TicTacToe(commands.Cog):
                     if board.X_turn
                     else board.challengers.get("o")
                 )
+                # When it's our turn, answer straight away from the solver
+                if player_turn == ctx.message.guild.me:
+                    board.update(*get_solver(board.size, board.k).best_move(board))
+                    await self.end_turn(ctx, board, bot_moved=True)
+                    return
                 fmt = str(board) + "\n{} It is now your turn to play!".format(
                     player_turn.display_name
                 )
@@ -738,22 +3262,18 @@ class TicTacToe(commands.Cog):
     @commands.guild_only()
     async def start_game(self, ctx, player2: discord.Member):
         """Starts a game of tictactoe with another player
+        Challenge the bot itself to play against a perfect opponent
         EXAMPLE: !tictactoe start @OtherPerson
         RESULT: A new game of tictactoe"""
         player1 = ctx.message.author
-        # For simplicities sake, only allow one game on a server at a time.
-        # Things can easily get confusing (on the server's end) if we allow more than one
-        if self.boards.get(ctx.message.guild.id) is not None:
-            await ctx.send(
-                "Sorry but only one Tic-Tac-Toe game can be running per server!"
-            )
-            return
-        # Make sure we're not being challenged, I always win anyway
-        if player2 == ctx.message.guild.me:
-            await ctx.send(
-                "You want to play? Alright lets play.\n\nI win, so quick you didn't even notice it."
-            )
-            return
+        # Each player can only be in one game per channel, so moves always know which board they're for
+        games = self.get_games(ctx.message.guild)
+        for player in (player1, player2):
+            if player != ctx.message.guild.me and games.find(ctx.channel.id, player) is not None:
+                await ctx.send(
+                    "Sorry but {} is already playing Tic-Tac-Toe in this channel!".format(player.display_name)
+                )
+                return
         if player2 == player1:
             await ctx.send(
                 "You can't play yourself, I won't allow it. Go find some friends"
@@ -761,41 +3281,237 @@ class TicTacToe(commands.Cog):
             return
 
         # Create the board and return who has been decided to go first
-        x_player = self.create(ctx.message.guild.id, player1, player2)
+        board = self.create(ctx, player1, player2)
+        if board is None:
+            await ctx.send("There are too many Tic-Tac-Toe games running right now, try again later!")
+            return
+        x_player = board.challengers["x"]
+
+        # Playing against us, solve the whole game up front so every move after is a lookup
+        if player2 == ctx.message.guild.me:
+            solver = get_solver(board.size, board.k)
+            if not solver.best:
+                await asyncio.get_event_loop().run_in_executor(None, solver.warm)
+            if x_player == player2:
+                board.update(*solver.best_move(board))
+
         fmt = "A tictactoe game has just started between {} and {}\n".format(
             player1.display_name, player2.display_name
         )
         # Print the board too just because
-        fmt += str(self.boards[ctx.message.guild.id])
+        fmt += str(board)
 
         # We don't need to do anything weird with assigning x_player to something
         # it is already a member object, just use it
-        fmt += (
-            "I have decided at random, and {} is going to be x's this game. It is your turn first! "
-            "Use the {}tictactoe command, and a position, to choose where you want to play".format(
-                x_player.display_name, ctx.prefix
+        if x_player == ctx.message.guild.me:
+            fmt += (
+                "I have decided at random, and I am going to be x's this game, so I went first. "
+                "Use the {}tictactoe command, and a position, to choose where you want to play".format(
+                    ctx.prefix
+                )
+            )
+        else:
+            fmt += (
+                "I have decided at random, and {} is going to be x's this game. It is your turn first! "
+                "Use the {}tictactoe command, and a position, to choose where you want to play".format(
+                    x_player.display_name, ctx.prefix
+                )
             )
-        )
         await ctx.send(fmt)
 
     @tictactoe.command(name="delete", aliases=["stop", "remove", "end"])
-    @commands.guild_only()    
-    async def stop_game(self, ctx):
-        """Force stops a game of tictactoe
+    @commands.guild_only()
+    async def stop_game(self, ctx, player: discord.Member = None):
+        """Force stops a game of tictactoe in this channel
+        Stops your own game, or the game of whoever you mention
         This should realistically only be used in a situation like one player leaves
         Hopefully a moderator will not abuse it, but there's not much we can do to avoid that
         EXAMPLE: !tictactoe stop
         RESULT: No more tictactoe!"""
-        if self.boards.get(ctx.message.guild.id) is None:
-            await ctx.send("There are no tictactoe games running on this server!")
+        games = self.get_games(ctx.message.guild)
+        board = games.find(ctx.channel.id, player or ctx.message.author)
+        if board is None:
+            await ctx.send("There is no tictactoe game to stop in this channel!")
             return
 
-        del self.boards[ctx.message.guild.id]
+        games.remove(board)
         await ctx.send(
             "I have just stopped the game of TicTacToe, a new should be able to be started now!"
         )
-    
-bot = commands.Bot(command_prefix='m.',intents=discord.Intents.all(), activity=discord.Game("m.help"))
+
+
+metrics.gauge("tictactoe_boards", "TicTacToe games in progress, by shard.",
+              lambda: {shard_id: len(store) for shard_id, store in TicTacToe.games.items()}, ("shard",))
+
+
+def _client_options(profile: str):
+    if profile == 'full':
+        return {'intents': discord.Intents.all()}
+
+    # Just what the bot uses: guilds, voice states for the music player,
+    # guild messages for the m. prefix, members for on_member_join and
+    # converters, and emojis for the welcome message. Members are cached
+    # only while in voice or after joining, servers aren't chunked at
+    # startup and messages aren't cached at all.
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.emojis = True
+
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags(online=False, voice=True, joined=True),
+        'chunk_guilds_at_startup': False,
+        'max_messages': None,
+    }
+
+
+# BOT_PROFILE=full brings back every intent and the default caches
+profile = os.environ.get('BOT_PROFILE', 'slim')
+warmup = os.environ.get('BOT_WARMUP', 'background')
+options = dict(_client_options(profile), command_prefix='m.', activity=discord.Game("m.help"))
+
+# Sharded mode runs one group of shards per process, e.g. SHARD_COUNT=8 and
+# SHARD_IDS=0,1,2,3 on one host and SHARD_IDS=4,5,6,7 on another
+if os.environ.get('SHARD_COUNT'):
+    shard_ids = os.environ.get('SHARD_IDS')
+    bot = commands.AutoShardedBot(shard_count=int(os.environ['SHARD_COUNT']),
+                                  shard_ids=[int(i) for i in shard_ids.split(',')] if shard_ids else None,
+                                  **options)
+else:
+    bot = commands.Bot(**options)
+
+
+def _rss():
+    # Current resident memory in bytes, falling back to the peak where /proc isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@bot.command(name='shards')
+async def shards(ctx):
+    """Shows voice sessions, queue sizes and games for each shard of this process."""
+
+    music = bot.get_cog('Music')
+    tictactoe = bot.get_cog('TicTacToe')
+
+    shard_ids = sorted(bot.shards) if isinstance(bot, commands.AutoShardedBot) else [0]
+    lines = []
+    for shard_id in shard_ids:
+        stats = music.shard_stats(shard_id)
+        guilds = sum(1 for guild in bot.guilds if (guild.shard_id or 0) == shard_id)
+        lines.append('`{}` {} guilds, {} voice states ({:.1f} KiB), {} voice sessions, {} queued songs, '
+                     '{} tictactoe games'.format(shard_id, guilds, stats['voice_states'], stats['state_bytes'] / 1024,
+                                                 stats['voice_sessions'], stats['queued_songs'],
+                                                 len(tictactoe.games.get(shard_id, ()))))
+
+    sent = Outbox.stats
+    lines.append('Outbound: {} messages, {} edits, {} coalesced, {} errors, {:.0f}ms average send ({:.0f}ms max), '
+                 '{:.0f}ms average queued'.format(sent['messages'], sent['edits'], sent['coalesced'], sent['errors'],
+                                                  sent['send_seconds'] * 1000 / max(sent['messages'], 1),
+                                                  sent['send_max'] * 1000,
+                                                  sent['queued_seconds'] * 1000 / max(sent['messages'], 1)))
+    lines.append('Memory: {:.1f} MiB, {} profile, ready in {:.1f}s'.format(
+        _rss() / 1024 ** 2, profile, getattr(bot, 'ready_time', 0)))
+    await ctx.send('\n'.join(lines))
+
+
+@bot.command(name='metrics')
+@commands.is_owner()
+async def dump_metrics(ctx):
+    """Dumps the bot's metrics in Prometheus' text format."""
+
+    await ctx.send(file=discord.File(io.BytesIO(metrics.render().encode()), 'metrics.txt'))
+
+
+@bot.command(name='profile')
+@commands.is_owner()
+async def take_profile(ctx, seconds: float = 10):
+    """Samples what the bot is doing for a while and saves it as folded stacks for a flamegraph."""
+
+    seconds = min(max(seconds, 1), 120)
+    try:
+        path, counts = await bot.loop.run_in_executor(None, profiler.run, seconds)
+    except RuntimeError as e:
+        return await ctx.send(str(e))
+
+    # The leaf frames of the event loop's thread are what stalls every guild
+    leaves = collections.Counter()
+    for stack, count in counts.items():
+        if stack.startswith('MainThread;'):
+            leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(leaves.values()) or 1
+
+    lines = ['Saved {} samples to `{}`, busiest on the event loop:'.format(sum(counts.values()), path)]
+    lines.extend('`{:5.1f}%` {}'.format(count * 100 / total, leaf) for leaf, count in leaves.most_common(5))
+    await ctx.send('\n'.join(lines))
+
+
+@bot.command(name='stalls')
+@commands.is_owner()
+async def stalls(ctx):
+    """Lists the latest times the event loop was blocked, and where."""
+
+    if not watchdog.stalls:
+        return await ctx.send('The event loop hasn\'t been blocked.')
+
+    lines = []
+    for stall in reversed(watchdog.stalls):
+        seconds = '{:.2f}s'.format(stall['seconds']) if stall['seconds'] else 'ongoing'
+        lines.append('{} {} in `{}`'.format(time.strftime('%H:%M:%S', time.localtime(stall['at'])), seconds,
+                                             stall['where']))
+
+    latest = ''.join(traceback.format_list(watchdog.stalls[-1]['stack'][-6:]))
+    await ctx.send('\n'.join(lines) + '\n```\n{}```'.format(latest[-800:]))
+
+
+@bot.before_invoke
+async def track_command(ctx):
+    # Lets the watchdog blame a blocked loop on the command being run
+    watchdog.commands[asyncio.current_task()] = ctx.command.qualified_name
+
+
+async def warm():
+    started = time.perf_counter()
+    await bot.loop.run_in_executor(None, YTDLSource.warm)
+    print('Warmed up in {:.2f}s ({})'.format(
+        time.perf_counter() - started, ', '.join('{} {:.2f}s'.format(name, seconds) for name, seconds in deferred.items())))
+
+
+@bot.event
+async def on_connect():
+    # Only the first connect is part of startup, later ones are reconnects
+    if 'connect' not in startup:
+        _stage_done('connect')
+
+
+@bot.event
+async def on_ready():
+    # on_ready fires again after reconnects, only the first one is startup
+    if hasattr(bot, 'ready_time'):
+        return
+
+    _stage_done('gateway')
+    bot.ready_time = time.perf_counter() - _imports_started
+    print('Ready with the {} profile in {:.1f}s ({}), {} guilds, {:.1f} MiB resident'.format(
+        profile, bot.ready_time, ', '.join('{} {:.2f}s'.format(stage, seconds) for stage, seconds in startup.items()),
+        len(bot.guilds), _rss() / 1024 ** 2))
+
+    watchdog.start(bot.loop)
+    # BOT_WARMUP=lazy leaves loading youtube_dl and finding FFmpeg to the first m.play
+    if warmup == 'background':
+        bot.loop.create_task(warm())
+    # METRICS_PORT=9100 serves the metrics for Prometheus to scrape, on
+    # localhost unless METRICS_HOST says otherwise
+    if os.environ.get('METRICS_PORT'):
+        await metrics.serve(os.environ.get('METRICS_HOST', '127.0.0.1'), int(os.environ['METRICS_PORT']))
+
 
 @bot.event
 async def on_member_join(member):
@@ -806,7 +3522,9 @@ async def on_member_join(member):
         await channel.send(f"""welcome {member.mention} {emojis['Rainbow_Welcome']}, get some roles from <#996760226453798942> and see rules at <#996360987320004608>""")
     
     
-bot.add_cog(Music(bot))
-bot.add_cog(TicTacToe(bot))
+if __name__ == '__main__':
+    bot.add_cog(Music(bot))
+    bot.add_cog(TicTacToe(bot))
+    _stage_done('setup')
 
-bot.run("<>")
+    bot.run("<>")